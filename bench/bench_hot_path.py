@@ -0,0 +1,102 @@
+"""消息热路径微基准：测量 handle_session_message 在无会话情况下的单条消息开销
+
+用法（需要已安装 astrbot）：
+    python bench/bench_hot_path.py [--messages 200000]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# AstrBot 在根目录（默认为工作目录）下创建 data/，未指定 ASTRBOT_ROOT 时在导入前指向临时目录
+if "ASTRBOT_ROOT" not in os.environ:
+    BENCH_ROOT = tempfile.TemporaryDirectory(prefix="pjsk-sticker-bench-")
+    os.environ["ASTRBOT_ROOT"] = BENCH_ROOT.name
+
+from astrbot.core.platform import AstrBotMessage, AstrMessageEvent, MessageMember, MessageType, PlatformMetadata  # noqa: E402
+
+from main import StickerPlugin  # noqa: E402
+
+
+def make_event(platform_meta, sender_id, text="今天吃什么"):
+    message = AstrBotMessage()
+    message.type = MessageType.GROUP_MESSAGE
+    message.group_id = "10000"
+    message.sender = MessageMember(user_id=sender_id, nickname=sender_id)
+    message.message_str = text
+    message.message = []
+    message.self_id = "bot"
+    message.session_id = "10000"
+    message.message_id = "1"
+    return AstrMessageEvent(text, message, platform_meta, "10000")
+
+
+async def drain(agen):
+    async for _ in agen:
+        pass
+
+
+async def measure(plugin, events, rounds):
+    start = time.perf_counter()
+    for i in range(rounds):
+        await drain(plugin.handle_session_message(events[i % len(events)]))
+    return (time.perf_counter() - start) / rounds * 1e9
+
+
+def measure_prefilter(plugin, events, rounds):
+    """仅测量快速路径的预过滤判断"""
+    sessions = plugin.sessions
+    start = time.perf_counter()
+    for i in range(rounds):
+        event = events[i % len(events)]
+        not sessions or not sessions.has_sender(event.get_sender_id())
+    return (time.perf_counter() - start) / rounds * 1e9
+
+
+def measure_full_key(plugin, events, rounds):
+    """对照组：每条消息都先计算完整会话 key 再查表（优化前的做法）"""
+    sessions = plugin.sessions
+    start = time.perf_counter()
+    for i in range(rounds):
+        plugin._get_session_key(events[i % len(events)]) in sessions
+    return (time.perf_counter() - start) / rounds * 1e9
+
+
+async def measure_empty_generator(events, rounds):
+    """基线：AstrBot 调用一个立即返回的异步生成器处理器本身的开销"""
+    async def handler(event):
+        return
+        yield
+
+    start = time.perf_counter()
+    for i in range(rounds):
+        await drain(handler(events[i % len(events)]))
+    return (time.perf_counter() - start) / rounds * 1e9
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=200000)
+    args = parser.parse_args()
+
+    platform_meta = PlatformMetadata(name="aiocqhttp", description="bench", id="aiocqhttp")
+    plugin = StickerPlugin(None, {"api_url": "http://127.0.0.1/api"})
+    events = [make_event(platform_meta, f"user{i}") for i in range(100)]
+
+    rounds = args.messages
+    print(f"基线：空异步生成器处理器          {await measure_empty_generator(events, rounds):8.1f} ns/条")
+    print(f"处理器（会话表为空）              {await measure(plugin, events, rounds):8.1f} ns/条")
+    print(f"预过滤判断（会话表为空）          {measure_prefilter(plugin, events, rounds):8.1f} ns/条")
+    for i in range(1000):
+        plugin.sessions[("aiocqhttp", f"other{i}")] = {"step": "select_pack"}
+    print(f"处理器（1000 个其他用户的会话）   {await measure(plugin, events, rounds):8.1f} ns/条")
+    print(f"预过滤判断（1000 个其他用户）     {measure_prefilter(plugin, events, rounds):8.1f} ns/条")
+    print(f"对照：计算完整会话 key 后查表     {measure_full_key(plugin, events, rounds):8.1f} ns/条")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,321 @@
+"""离线负载基准：用本地模拟渲染服务代替 api_url，测量插件在并发用户下的吞吐、延迟与峰值内存
+
+场景：
+- quick：每个用户反复发送 /draw pjsk <样式id> <文字>
+- interactive：每个用户走完整交互流程（/draw → pjsk → 角色 → 动作 → 文字）
+- regex：没有会话的用户发送普通消息，只经过全局消息监听器
+- list：每个用户反复发送 /draw list
+
+模拟渲染服务的延迟、抖动与错误率可调。每段文字都不相同，quick/interactive 场景
+不会命中贴纸缓存。结果以 JSON 保存，可用 --compare 与之前版本的结果对比。
+
+只通过命令与消息处理器驱动插件，样式 id 直接读取 list.json，不依赖插件内部实现，
+可以对任意版本的插件运行。AstrBot 的数据目录指向临时目录，不会在工作目录下留下 data/。
+
+用法（需要已安装 astrbot 与 httpx）：
+    python bench/bench_load.py [--users 50] [--iterations 20] [--latency-ms 80] [--error-rate 0.02]
+    python bench/bench_load.py --output new.json --compare old.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# AstrBot 在根目录（默认为工作目录）下创建 data/，未指定 ASTRBOT_ROOT 时在导入前指向临时目录
+if "ASTRBOT_ROOT" not in os.environ:
+    BENCH_ROOT = tempfile.TemporaryDirectory(prefix="pjsk-sticker-bench-")
+    os.environ["ASTRBOT_ROOT"] = BENCH_ROOT.name
+
+import astrbot.api.message_components as Comp  # noqa: E402
+from astrbot.core.platform import PlatformMetadata  # noqa: E402
+
+from bench_hot_path import drain, make_event  # noqa: E402
+from main import StickerPlugin  # noqa: E402
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("quick", "interactive", "regex", "list")
+
+
+def start_mock_render_server(payload, latency, jitter, error_rate):
+    """启动模拟渲染 API：按配置延迟后返回固定 PNG，按 error_rate 概率返回 500"""
+    stats = {"requests": 0, "errors": 0}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            time.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+            failed = random.random() < error_rate
+            with lock:
+                stats["requests"] += 1
+                stats["errors"] += failed
+            body = b"mock render error" if failed else payload
+            self.send_response(500 if failed else 200)
+            self.send_header("Content-Type", "text/plain" if failed else "image/png")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def do_HEAD(self):
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/api", stats
+
+
+def load_pjsk_styles():
+    """从 list.json 读取 PJSK 角色 id 与其可选的样式 id"""
+    with open(os.path.join(PLUGIN_DIR, "list.json"), encoding="utf-8") as f:
+        characters = json.load(f)["packs"]["pjsk"]["characters"]
+    return {character_id: character["id"] for character_id, character in characters.items() if character.get("id")}
+
+
+def has_image(result):
+    return result is not None and any(isinstance(c, Comp.Image) for c in result.chain)
+
+
+async def send_command(plugin, event):
+    results = [r async for r in plugin.start_sticker_session(event)]
+    return results[-1] if results else None
+
+
+async def send_message(plugin, event):
+    results = [r async for r in plugin.handle_session_message(event)]
+    return results[-1] if results else None
+
+
+class ScenarioRunner:
+    """按场景驱动插件，记录每次操作的延迟与成功与否"""
+
+    def __init__(self, plugin, platform_meta, pjsk_styles):
+        self.plugin = plugin
+        self.platform_meta = platform_meta
+        self.pjsk_styles = pjsk_styles
+        self.style_ids = sorted(style_id for style_ids in pjsk_styles.values() for style_id in style_ids)
+        self.counter = 0
+
+    def _unique_text(self, user):
+        self.counter += 1
+        return f"{user}-{self.counter}"
+
+    async def quick(self, user):
+        style_id = random.choice(self.style_ids)
+        event = make_event(self.platform_meta, user, f"/draw pjsk {style_id} {self._unique_text(user)}")
+        return has_image(await send_command(self.plugin, event))
+
+    async def interactive(self, user):
+        character_id = random.choice(list(self.pjsk_styles))
+        style_id = random.choice(self.pjsk_styles[character_id])
+        await send_command(self.plugin, make_event(self.platform_meta, user, "/draw"))
+        for text in ("pjsk", character_id, str(style_id)):
+            await send_message(self.plugin, make_event(self.platform_meta, user, text))
+        result = await send_message(self.plugin, make_event(self.platform_meta, user, self._unique_text(user)))
+        return has_image(result)
+
+    async def regex(self, user):
+        await drain(self.plugin.handle_session_message(make_event(self.platform_meta, user, "今天吃什么")))
+        return True
+
+    async def list(self, user):
+        return await send_command(self.plugin, make_event(self.platform_meta, user, "/draw list")) is not None
+
+    async def warm_characters(self, user):
+        """逐个选择 PJSK 角色后退出，让插件加载（或生成）所有角色样式表"""
+        for character_id in self.pjsk_styles:
+            await send_command(self.plugin, make_event(self.platform_meta, user, "/draw"))
+            for text in ("pjsk", character_id, "quit"):
+                await send_message(self.plugin, make_event(self.platform_meta, user, text))
+
+    async def open_sessions(self, count):
+        """让 count 个其他用户停留在选包步骤"""
+        for i in range(count):
+            await send_command(self.plugin, make_event(self.platform_meta, f"other{i}", "/draw"))
+
+    async def close_sessions(self, count):
+        for i in range(count):
+            await send_message(self.plugin, make_event(self.platform_meta, f"other{i}", "quit"))
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+async def run_scenario(runner, name, users, iterations, trace_memory):
+    operation = getattr(runner, name)
+    latencies = []
+    failures = 0
+
+    async def user_loop(index):
+        nonlocal failures
+        user = f"{name}-user{index}"
+        for _ in range(iterations):
+            start = time.perf_counter()
+            ok = await operation(user)
+            latencies.append(time.perf_counter() - start)
+            failures += not ok
+
+    if trace_memory:
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    await asyncio.gather(*(user_loop(i) for i in range(users)))
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    if trace_memory:
+        tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        "operations": len(latencies),
+        "failures": failures,
+        "elapsed_s": round(elapsed, 4),
+        "throughput_ops": round(len(latencies) / elapsed, 2),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.5) * 1000, 3),
+            "p95": round(percentile(latencies, 0.95) * 1000, 3),
+            "p99": round(percentile(latencies, 0.99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        },
+        "peak_memory_kb": round(peak / 1024, 1) if peak is not None else None,
+    }
+
+
+def read_plugin_version():
+    with open(os.path.join(PLUGIN_DIR, "metadata.yaml"), encoding="utf-8") as f:
+        match = re.search(r"^version:\s*(\S+)", f.read(), re.MULTILINE)
+    return match.group(1) if match else "unknown"
+
+
+def print_result(name, result):
+    latency = result["latency_ms"]
+    memory = f"{result['peak_memory_kb']:10.0f} KB" if result["peak_memory_kb"] is not None else "         -"
+    print(
+        f"{name:<12} {result['throughput_ops']:10.1f} ops/s  "
+        f"p50 {latency['p50']:9.2f}  p95 {latency['p95']:9.2f}  p99 {latency['p99']:9.2f} ms  "
+        f"峰值 {memory}  失败 {result['failures']}/{result['operations']}"
+    )
+
+
+def print_comparison(current, baseline):
+    print(f"\n与 {baseline['version']}（{baseline['timestamp']}）对比：")
+    for name, result in current["scenarios"].items():
+        old = baseline.get("scenarios", {}).get(name)
+        if old is None:
+            continue
+
+        def delta(new_value, old_value):
+            return f"{(new_value - old_value) / old_value:+.1%}" if old_value else "   n/a"
+
+        print(
+            f"{name:<12} 吞吐 {delta(result['throughput_ops'], old['throughput_ops'])}  "
+            f"p50 {delta(result['latency_ms']['p50'], old['latency_ms']['p50'])}  "
+            f"p95 {delta(result['latency_ms']['p95'], old['latency_ms']['p95'])}  "
+            f"p99 {delta(result['latency_ms']['p99'], old['latency_ms']['p99'])}"
+        )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50, help="并发模拟用户数")
+    parser.add_argument("--iterations", type=int, default=20, help="每个用户的操作次数")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="逗号分隔的场景列表")
+    parser.add_argument("--latency-ms", type=float, default=80, help="模拟渲染服务的平均延迟（毫秒）")
+    parser.add_argument("--jitter-ms", type=float, default=20, help="延迟的随机抖动范围（毫秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟渲染服务返回 500 的概率")
+    parser.add_argument("--payload-kb", type=int, default=200, help="模拟贴纸大小（KB）")
+    parser.add_argument("--no-tracemalloc", action="store_true", help="不测量峰值内存（tracemalloc 会降低吞吐）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="结果 JSON 文件路径")
+    parser.add_argument("--compare", help="与之前保存的结果 JSON 对比")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"未知场景: {', '.join(sorted(unknown))}")
+
+    server, api_url, server_stats = start_mock_render_server(
+        os.urandom(args.payload_kb * 1024), args.latency_ms / 1000, args.jitter_ms / 1000, args.error_rate
+    )
+    platform_meta = PlatformMetadata(name="aiocqhttp", description="bench", id="aiocqhttp")
+    # 基准测量的是渲染链路本身，关闭限流
+    plugin = StickerPlugin(
+        None, {"api_url": api_url, "prefetch": {"enabled": False}, "rate_limit": {"enabled": False}}
+    )
+    await plugin.initialize()
+    runner = ScenarioRunner(plugin, platform_meta, load_pjsk_styles())
+
+    report = {
+        "version": read_plugin_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "config": {
+            "users": args.users,
+            "iterations": args.iterations,
+            "latency_ms": args.latency_ms,
+            "jitter_ms": args.jitter_ms,
+            "error_rate": args.error_rate,
+            "payload_kb": args.payload_kb,
+            "tracemalloc": not args.no_tracemalloc,
+        },
+        "scenarios": {},
+    }
+    print(
+        f"{args.users} 个并发用户 × {args.iterations} 次，模拟渲染延迟 {args.latency_ms:g}±{args.jitter_ms:g} ms，"
+        f"错误率 {args.error_rate:.1%}"
+    )
+    # 预热：建立连接、加载参考图，不计入结果
+    await runner.warm_characters("warmup")
+    for name in scenarios:
+        await getattr(runner, name)("warmup")
+    for name in scenarios:
+        if name == "regex":
+            # 让全局监听器在有其他用户会话的情况下运行，更接近真实负载
+            await runner.open_sessions(1000)
+        result = await run_scenario(runner, name, args.users, args.iterations, not args.no_tracemalloc)
+        if name == "regex":
+            await runner.close_sessions(1000)
+        report["scenarios"][name] = result
+        print_result(name, result)
+
+    report["mock_server"] = dict(server_stats)
+    await plugin.terminate()
+    server.shutdown()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存到 {args.output}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print_comparison(report, json.load(f))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,121 @@
+"""贴纸下载与编码的单张峰值内存基准
+
+在本地启动一个返回固定大小 PNG 的 HTTP 服务，用 tracemalloc 分别测量：
+- 旧做法：response.content 整体缓冲 + b64encode().decode() + f-string 拼接
+- 流式下载（PooledHttpClient.fetch_image）+ to_base64_uri
+- 流式下载 + 文件路径发送（不做 base64 编码）
+以及上游返回超大图片时，流式下载在达到上限后中止的峰值内存。
+
+用法（需要已安装 astrbot 与 httpx）：
+    python bench/bench_sticker_memory.py [--size-kb 600] [--max-mb 10]
+"""
+
+import argparse
+import asyncio
+import base64
+import os
+import sys
+import tempfile
+import threading
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# AstrBot 在根目录（默认为工作目录）下创建 data/，未指定 ASTRBOT_ROOT 时在导入前指向临时目录
+if "ASTRBOT_ROOT" not in os.environ:
+    BENCH_ROOT = tempfile.TemporaryDirectory(prefix="pjsk-sticker-bench-")
+    os.environ["ASTRBOT_ROOT"] = BENCH_ROOT.name
+
+from main import PooledHttpClient, StickerTooLargeError, to_base64_uri  # noqa: E402
+
+
+def start_server(payload):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            try:
+                self.wfile.write(payload)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/sticker.png"
+
+
+async def measure(coro_factory):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    try:
+        result = await coro_factory()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak, result
+
+
+async def legacy(url):
+    async with httpx.AsyncClient() as client:
+        response = await client.get(url, timeout=30.0)
+        image_base64 = base64.b64encode(response.content).decode("utf-8")
+        return f"base64://{image_base64}"
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size-kb", type=int, default=600, help="正常贴纸大小（KB）")
+    parser.add_argument("--max-mb", type=float, default=10, help="下载大小上限（MB）")
+    args = parser.parse_args()
+
+    payload = os.urandom(args.size_kb * 1024)
+    server, url = start_server(payload)
+    client = PooledHttpClient(max_response_bytes=int(args.max_mb * 1024 * 1024))
+    # 先建立连接，避免把连接建立的内存算进去
+    await client.fetch_image(url)
+
+    async def streamed_base64():
+        _, image_bytes = await client.fetch_image(url)
+        return to_base64_uri(image_bytes)
+
+    async def streamed_file():
+        _, image_bytes = await client.fetch_image(url)
+        return len(image_bytes)
+
+    print(f"贴纸大小 {len(payload) / 1024:.0f} KB")
+    for name, factory in (
+        ("旧做法（response.content + f-string）", lambda: legacy(url)),
+        ("流式下载 + base64", streamed_base64),
+        ("流式下载 + 文件路径发送", streamed_file),
+    ):
+        peak, _ = await measure(factory)
+        print(f"{name:<32} 峰值 {peak / 1024:10.0f} KB（{peak / len(payload):.2f}x）")
+    server.shutdown()
+
+    huge = os.urandom(int(args.max_mb * 4 * 1024 * 1024))
+    server, url = start_server(huge)
+
+    async def oversized():
+        try:
+            await client.fetch_image(url)
+        except StickerTooLargeError as e:
+            return str(e)
+
+    peak, message = await measure(oversized)
+    print(f"上游返回 {len(huge) / 1024 / 1024:.0f} MB：{message}，峰值 {peak / 1024:.0f} KB")
+    server.shutdown()
+    await client.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,23 +1,1445 @@
 from astrbot.api.event import filter, AstrMessageEvent, MessageEventResult
-from astrbot.api.star import Context, Star, register
+from astrbot.api.star import Context, Star, StarTools, register
 from astrbot.api import logger, AstrBotConfig
 import astrbot.api.message_components as Comp
+import asyncio
+import hashlib
+import math
+import random
 import json
 import os
+import pickle
 import re
+import sys
+import time
+from array import array
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from types import MappingProxyType
 import urllib.parse
 import base64
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import httpx
 
-@register("astrbot_plugin_pjsk_sticker", "kamicry", "pjsk表情包生成器", "v1.2.1")
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+try:
+    from PIL import Image, ImageChops, ImageDraw, ImageFont, features
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+PLUGIN_NAME = "astrbot_plugin_pjsk_sticker"
+# 启动时预热的高频参考图
+HOT_LIST_IMAGES = ("characterListWithIndex.jpeg", "arcaea_list.jpg")
+BASE_IMAGE_HUB_URL = "https://raw.githubusercontent.com/kamicry/arcpjsk-hub/main"
+
+# pjsk 角色代表色，本地渲染时作为文字颜色
+PJSK_CHARACTER_COLORS = {
+    "Miku": "#33CCBB", "Rin": "#FFCC11", "Len": "#FFEE11", "Luka": "#FFBBCC",
+    "Meiko": "#DD4444", "KAITO": "#3366CC", "Ichika": "#33AAEE", "Saki": "#FFDD44",
+    "Honami": "#EE6666", "Shiho": "#BBDD22", "Minori": "#FFCCAA", "Haruka": "#99CCFF",
+    "Airi": "#FFAACC", "Shizuku": "#99EEDD", "Kohane": "#FF6699", "An": "#00BBDD",
+    "Akito": "#FF7722", "Touya": "#0077DD", "Tsukasa": "#FFBB00", "Emu": "#FF66BB",
+    "Nene": "#33DD99", "Rui": "#BB88EE", "Kanade": "#BB6688", "Mafuyu": "#8888CC",
+    "Ena": "#CCAA88", "Mizuki": "#DDAACC",
+}
+
+
+class RenderApiError(Exception):
+    """渲染 API 调用失败的基类"""
+
+
+class CircuitOpenError(RenderApiError):
+    """渲染 API 熔断中，请求被直接拒绝"""
+
+
+class RenderTimeoutError(RenderApiError):
+    """渲染请求超过截止时间"""
+
+
+class RenderQueueFullError(RenderApiError):
+    """排队等待并发槽位超过截止时间，请求未发往渲染 API"""
+
+
+class StickerTooLargeError(RenderApiError):
+    """渲染 API 返回的图片超过大小上限"""
+
+
+class UnexpectedContentTypeError(RenderApiError):
+    """渲染 API 返回的不是图片"""
+
+
+class CatalogError(Exception):
+    """list.json 结构不合法"""
+
+
+def to_base64_uri(data):
+    """把图片数据编码为 base64:// URI"""
+    return "base64://" + base64.b64encode(data).decode("ascii")
+
+
+class PooledHttpClient:
+    """插件生命周期内共享的 httpx 客户端，复用 keep-alive 连接并统计连接池指标"""
+
+    def __init__(self, max_connections=20, max_keepalive_connections=10, keepalive_expiry=30.0,
+                 connect_timeout=5.0, read_timeout=30.0, http2=True, max_response_bytes=10 * 1024 * 1024):
+        self.http2 = bool(http2) and HTTP2_AVAILABLE
+        self.max_response_bytes = max_response_bytes
+        self.keepalive_expiry = keepalive_expiry
+        self._last_warm = 0.0
+        self._client = httpx.AsyncClient(
+            http2=self.http2,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        )
+        self.stats = {"requests": 0, "connections_opened": 0, "connections_reused": 0, "aborted": 0, "warmups": 0}
+
+    async def warm(self, url):
+        """发送 HEAD 请求预先建立到渲染 API 的连接，半个 keep-alive 周期内只预热一次"""
+        now = time.monotonic()
+        if now - self._last_warm < self.keepalive_expiry / 2:
+            return
+        self._last_warm = now
+        try:
+            await self._client.head(url)
+        except httpx.HTTPError as e:
+            logger.debug(f"预热渲染 API 连接失败: {e}")
+            return
+        self.stats["warmups"] += 1
+
+    async def fetch_image(self, url):
+        """流式下载图片，返回 (状态码, 图片数据)，状态码非 200 时图片数据为 None
+
+        先检查状态码与 Content-Type 再读取正文，正文边接收边累加到同一块缓冲区，
+        超过 max_response_bytes 时立即中止并断开连接。图片数据为 bytearray。
+        """
+        opened = False
+
+        async def trace(event_name, info):
+            nonlocal opened
+            if event_name == "connection.connect_tcp.complete":
+                opened = True
+
+        async with self._client.stream("GET", url, extensions={"trace": trace}) as response:
+            self.stats["requests"] += 1
+            if opened:
+                self.stats["connections_opened"] += 1
+            else:
+                self.stats["connections_reused"] += 1
+            if response.status_code != 200:
+                return response.status_code, None
+            content_type = response.headers.get("content-type", "")
+            if not content_type.startswith("image/"):
+                self.stats["aborted"] += 1
+                raise UnexpectedContentTypeError(f"渲染 API 返回了非图片内容（{content_type or '未知类型'}）")
+            content_length = response.headers.get("content-length", "")
+            if content_length.isdigit() and int(content_length) > self.max_response_bytes:
+                self.stats["aborted"] += 1
+                raise StickerTooLargeError(f"图片大小超过上限（{int(content_length)} 字节）")
+            buffer = bytearray()
+            async for chunk in response.aiter_bytes():
+                if len(buffer) + len(chunk) > self.max_response_bytes:
+                    self.stats["aborted"] += 1
+                    raise StickerTooLargeError(f"图片大小超过上限（{self.max_response_bytes} 字节）")
+                buffer += chunk
+            return 200, buffer
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+class BlockingIoRunner:
+    """在专用线程池中执行阻塞的文件读写与编码，并按操作类型统计本会阻塞事件循环的耗时"""
+
+    def __init__(self, workers=2):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pjsk-io")
+        self._lock = threading.Lock()
+        self.stats = {}
+
+    async def run(self, label, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._timed, label, func, args)
+
+    def _timed(self, label, func, args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with self._lock:
+                entry = self.stats.setdefault(label, {"calls": 0, "total_ms": 0.0, "max_ms": 0.0})
+                entry["calls"] += 1
+                entry["total_ms"] += elapsed_ms
+                entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class StickerCache:
+    """渲染结果两级缓存：按字节限制的内存 LRU + 可选的磁盘缓存（容量上限 + TTL）
+
+    缓存以 _build_sticker_url 生成的 URL 的 sha256 作为键，相同的
+    (pack, 角色, 样式, 文字) 组合会命中同一条缓存。磁盘缓存按写入时间先进先出淘汰，
+    命中不会延长文件的保留时间。
+    """
+
+    # 以文件路径发送后，平台可能稍后才读取文件，这段时间内不淘汰、不删除该文件
+    PIN_SECONDS = 300
+
+    def __init__(self, io_runner, memory_max_bytes=32 * 1024 * 1024, disk_dir=None,
+                 disk_max_bytes=256 * 1024 * 1024, disk_ttl=7 * 24 * 3600):
+        self.io_runner = io_runner
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_ttl = disk_ttl
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_index = {}
+        self._disk_bytes = 0
+        self._pinned = OrderedDict()
+        self.stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "memory_evictions": 0,
+            "disk_evictions": 0,
+            "disk_expired": 0,
+        }
+
+    @staticmethod
+    def make_key(url):
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.png")
+
+    def _disk_expired(self, entry):
+        return bool(self.disk_ttl) and time.time() - entry[1] > self.disk_ttl
+
+    def _is_pinned(self, key):
+        now = time.monotonic()
+        while self._pinned and next(iter(self._pinned.values())) <= now:
+            self._pinned.popitem(last=False)
+        return key in self._pinned
+
+    def contains(self, url):
+        """只查内存与磁盘索引判断是否已缓存，不读取数据"""
+        key = self.make_key(url)
+        if key in self._memory:
+            return True
+        entry = self._disk_index.get(key)
+        return entry is not None and not self._disk_expired(entry)
+
+    def disk_path(self, url):
+        """返回未过期的磁盘缓存贴纸文件路径，并在 PIN_SECONDS 内保护该文件；不在磁盘缓存中时返回 None"""
+        if not self.disk_dir:
+            return None
+        key = self.make_key(url)
+        entry = self._disk_index.get(key)
+        if entry is None or self._disk_expired(entry):
+            return None
+        self._pinned[key] = time.monotonic() + self.PIN_SECONDS
+        self._pinned.move_to_end(key)
+        return self._disk_path(key)
+
+    def _scan_disk(self):
+        """扫描磁盘缓存目录，返回 键 -> (大小, 修改时间)（阻塞，在 IO 线程池中执行）"""
+        os.makedirs(self.disk_dir, exist_ok=True)
+        index = {}
+        for entry in os.scandir(self.disk_dir):
+            if not entry.is_file() or not entry.name.endswith(".png"):
+                continue
+            stat = entry.stat()
+            index[entry.name[:-4]] = (stat.st_size, stat.st_mtime)
+        return index
+
+    async def load_disk_index(self):
+        """重建磁盘缓存索引，超出容量的旧文件随即淘汰"""
+        if not self.disk_dir:
+            return
+        index = await self.io_runner.run("sticker_cache_index", self._scan_disk)
+        self._disk_index = index
+        self._disk_bytes = sum(size for size, _ in index.values())
+        await self._evict_disk()
+
+    def _memory_get(self, key):
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+        return data
+
+    def _memory_put(self, key, data):
+        size = len(data)
+        if size > self.memory_max_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= len(old)
+        self._memory[key] = data
+        self._memory_bytes += size
+        while self._memory_bytes > self.memory_max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self.stats["memory_evictions"] += 1
+
+    # 磁盘索引只在事件循环中读写，IO 线程池只负责文件读写与删除
+
+    @staticmethod
+    def _read_file(path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    @staticmethod
+    def _write_file(path, data):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _remove_files(paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _drop_disk_entry(self, key):
+        entry = self._disk_index.pop(key, None)
+        if entry is not None:
+            self._disk_bytes -= entry[0]
+        return self._disk_path(key)
+
+    async def _remove_disk_entries(self, keys):
+        paths = [self._drop_disk_entry(key) for key in keys]
+        if paths:
+            await self.io_runner.run("sticker_cache_remove", self._remove_files, paths)
+
+    async def _evict_disk(self):
+        if self._disk_bytes <= self.disk_max_bytes:
+            return
+        evicted = []
+        remaining = self._disk_bytes
+        for key, (size, _) in sorted(self._disk_index.items(), key=lambda item: item[1][1]):
+            if remaining <= self.disk_max_bytes:
+                break
+            if self._is_pinned(key):
+                # 正在等待平台读取的文件暂不淘汰，容量可能短时超出上限
+                continue
+            remaining -= size
+            evicted.append(key)
+        self.stats["disk_evictions"] += len(evicted)
+        await self._remove_disk_entries(evicted)
+
+    async def _disk_get(self, key):
+        entry = self._disk_index.get(key)
+        if entry is None:
+            return None
+        if self._disk_expired(entry):
+            if not self._is_pinned(key):
+                self.stats["disk_expired"] += 1
+                await self._remove_disk_entries([key])
+            # 被保护的过期文件按未命中处理，重新渲染后原子替换
+            return None
+        try:
+            return await self.io_runner.run("sticker_cache_read", self._read_file, self._disk_path(key))
+        except OSError:
+            self._drop_disk_entry(key)
+            return None
+
+    async def _disk_put(self, key, data):
+        await self.io_runner.run("sticker_cache_write", self._write_file, self._disk_path(key), data)
+        self._drop_disk_entry(key)
+        self._disk_index[key] = (len(data), time.time())
+        self._disk_bytes += len(data)
+        await self._evict_disk()
+
+    async def get(self, url):
+        """查询缓存，命中磁盘时回填内存；未命中返回 None"""
+        key = self.make_key(url)
+        data = self._memory_get(key)
+        if data is not None:
+            self.stats["memory_hits"] += 1
+            return data
+        if self.disk_dir and key in self._disk_index:
+            data = await self._disk_get(key)
+            if data is not None:
+                self.stats["disk_hits"] += 1
+                self._memory_put(key, data)
+                return data
+        self.stats["misses"] += 1
+        return None
+
+    async def put(self, url, data):
+        key = self.make_key(url)
+        self._memory_put(key, data)
+        if self.disk_dir:
+            try:
+                await self._disk_put(key, data)
+            except OSError as e:
+                logger.warning(f"写入贴纸磁盘缓存失败: {e}")
+
+    def summary(self):
+        """返回当前缓存占用与命中统计"""
+        return dict(
+            self.stats,
+            memory_entries=len(self._memory),
+            memory_bytes=self._memory_bytes,
+            disk_entries=len(self._disk_index),
+            disk_bytes=self._disk_bytes,
+        )
+
+
+class CircuitBreaker:
+    """简单的熔断器：连续失败达到阈值后熔断，冷却后放行一次探测请求"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, recovery_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self.stats = {"opened": 0, "rejected": 0}
+
+    def allow(self):
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.recovery_timeout:
+                self.stats["rejected"] += 1
+                return False
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            if self._probe_in_flight:
+                self.stats["rejected"] += 1
+                return False
+            self._probe_in_flight = True
+        return True
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+
+    def release_probe(self):
+        """请求没有真正发往上游（排队超时或被取消）时交还半开探测名额，不计成功或失败"""
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self._probe_in_flight = False
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.stats["opened"] += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class TokenBucketLimiter:
+    """按 key 的令牌桶限流：每个 key 最多积攒 burst 个令牌，每秒恢复 rate 个
+
+    超过 burst 的请求（如大批量生成）在桶满时放行，但按全额扣除，令牌变为负数，
+    之后的请求需要等待欠下的令牌恢复，长期速率不会超过 rate。
+    只保留最近活跃的 max_keys 个桶，长时间不活跃的桶已经回满，淘汰后等价于新桶。
+    """
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    def _tokens(self, key, now):
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def wait_time(self, key, cost=1):
+        """返回令牌足够前需要等待的秒数，0 表示可以立即放行（不扣除令牌）"""
+        missing = min(cost, self.burst) - self._tokens(key, time.monotonic())
+        return missing / self.rate if missing > 0 else 0.0
+
+    def consume(self, key, cost=1):
+        now = time.monotonic()
+        self._buckets[key] = (self._tokens(key, now) - cost, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+
+
+class FairScheduler:
+    """公平的并发槽位分配：同一队列 key 内先到先得，不同 key 之间轮流分配
+
+    渲染请求按群（私聊按用户）排队，一个繁忙的群不会饿死其他群的请求。
+    """
+
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        self.waiting = 0
+        self._queues = OrderedDict()
+
+    @property
+    def queued_keys(self):
+        return len(self._queues)
+
+    async def acquire(self, key=None):
+        if self.active < self.max_concurrency and not self._queues:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(key, deque()).append(future)
+        self.waiting += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self._discard(key, future)
+            else:
+                # 槽位已分配给本请求，交还给下一个等待者
+                self.release()
+            raise
+        finally:
+            self.waiting -= 1
+
+    def _discard(self, key, future):
+        queue = self._queues.get(key)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            if not queue:
+                del self._queues[key]
+
+    def release(self):
+        self.active -= 1
+        while self.active < self.max_concurrency and self._queues:
+            key, queue = next(iter(self._queues.items()))
+            future = queue.popleft()
+            if queue:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+            if not future.done():
+                self.active += 1
+                future.set_result(None)
+
+    def position(self, key=None):
+        """估算该 key 的新请求在队列中的位置（从 1 开始），可以立即执行时返回 0"""
+        if self.active < self.max_concurrency and not self._queues:
+            return 0
+        own = len(self._queues.get(key, ()))
+        # 轮询下，排在本 key 第 own 个之后的请求前面，其他 key 各自最多还有 own + 1 个
+        ahead = own + sum(min(len(queue), own + 1) for k, queue in self._queues.items() if k != key)
+        return ahead + 1
+
+
+class ResilientRenderClient:
+    """渲染 API 调用包装：并发上限、整体截止时间、5xx/超时的抖动重试与熔断"""
+
+    def __init__(self, client, max_concurrency=8, deadline=45.0, max_retries=2,
+                 retry_backoff=0.5, breaker=None):
+        self.client = client
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.scheduler = FairScheduler(max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.stats = {"requests": 0, "retries": 0, "failures": 0, "timeouts": 0, "queue_timeouts": 0}
+
+    @property
+    def waiting(self):
+        return self.scheduler.waiting
+
+    @property
+    def active(self):
+        return self.scheduler.active
+
+    async def get(self, url, queue_key=None):
+        """在并发上限与截止时间内请求渲染 API，返回最后一次的 (状态码, 图片数据)
+
+        并发已满时按 queue_key 公平排队，排队时间计入截止时间。只有拿到槽位后的上游请求
+        结果会计入熔断器，排队超时只是本地拒绝，不代表渲染服务故障。
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError("渲染服务暂时不可用，请稍后再试")
+        self.stats["requests"] += 1
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        try:
+            await asyncio.wait_for(self.scheduler.acquire(queue_key), self.deadline)
+        except asyncio.TimeoutError:
+            self.stats["queue_timeouts"] += 1
+            self.breaker.release_probe()
+            raise RenderQueueFullError("渲染队列已满，请稍后再试")
+        except asyncio.CancelledError:
+            self.breaker.release_probe()
+            raise
+        try:
+            status_code, image_bytes = await asyncio.wait_for(
+                self._get_with_retries(url), max(0.0, deadline - loop.time())
+            )
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            self.stats["failures"] += 1
+            self.breaker.record_failure()
+            raise RenderTimeoutError(f"渲染请求超时（超过 {self.deadline:g} 秒）")
+        except asyncio.CancelledError:
+            self.breaker.release_probe()
+            raise
+        except Exception:
+            self.stats["failures"] += 1
+            self.breaker.record_failure()
+            raise
+        finally:
+            self.scheduler.release()
+        if status_code >= 500:
+            self.stats["failures"] += 1
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return status_code, image_bytes
+
+    async def _get_with_retries(self, url):
+        attempt = 0
+        while True:
+            try:
+                status_code, image_bytes = await self.client.fetch_image(url)
+                if status_code < 500 or attempt >= self.max_retries:
+                    return status_code, image_bytes
+            except (httpx.TimeoutException, httpx.TransportError):
+                if attempt >= self.max_retries:
+                    raise
+            attempt += 1
+            self.stats["retries"] += 1
+            await asyncio.sleep(self.retry_backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+
+    def summary(self):
+        """返回熔断器状态、排队深度与调用统计"""
+        return dict(
+            self.stats,
+            breaker_state=self.breaker.state,
+            breaker_opened=self.breaker.stats["opened"],
+            breaker_rejected=self.breaker.stats["rejected"],
+            waiting=self.waiting,
+            queued_keys=self.scheduler.queued_keys,
+            active=self.active,
+            max_concurrency=self.max_concurrency,
+        )
+
+
+class SingleFlight:
+    """合并相同键的并发请求：同一时刻只发起一次上游调用，其余调用共享其结果或异常"""
+
+    def __init__(self):
+        self._inflight = {}
+        self.stats = {"calls": 0, "coalesced": 0}
+
+    async def do(self, key, factory):
+        self.stats["calls"] += 1
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            self.stats["coalesced"] += 1
+        # shield 保证单个等待者被取消时不会取消其他人共享的上游请求
+        return await asyncio.shield(task)
+
+    def _finish(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # 取走异常，避免所有等待者都已取消时出现 "exception was never retrieved"
+            task.exception()
+
+    @property
+    def inflight(self):
+        return len(self._inflight)
+
+
+class ThumbnailSheetCache:
+    """由 list/ 参考图生成的压缩缩略图（WebP/JPEG），按源文件 sha256 与生成参数缓存在磁盘
+
+    尺寸限制在 max_width x max_height 内，编码后超过 max_bytes 时逐步降低质量；
+    rows_per_page 大于 0 时按背景色检测图中的行，每页只保留若干行，用于样式表分页。
+    """
+
+    def __init__(self, io_runner, list_dir, cache_dir, image_format="webp", quality=80,
+                 max_width=960, max_height=1280, max_bytes=300 * 1024, rows_per_page=0):
+        self.io_runner = io_runner
+        self.list_dir = list_dir
+        self.cache_dir = cache_dir
+        if image_format == "webp" and not features.check("webp"):
+            logger.warning("当前 Pillow 不支持 WebP，缩略图改用 JPEG")
+            image_format = "jpeg"
+        self.image_format = image_format
+        self.quality = quality
+        self.max_width = max_width
+        self.max_height = max_height
+        self.max_bytes = max_bytes
+        self.rows_per_page = rows_per_page
+        self._pages = {}
+        self._flight = SingleFlight()
+        self.stats = {"built": 0, "reused": 0, "source_bytes": 0, "sheet_bytes": 0}
+
+    @property
+    def extension(self):
+        return "webp" if self.image_format == "webp" else "jpg"
+
+    def invalidate(self):
+        """源图可能已变化（如重新加载目录后），下次使用时重新校验"""
+        self._pages.clear()
+
+    async def get_pages(self, name, paginate=False):
+        """返回缩略图各页的文件路径列表，首次使用时在 IO 线程池中生成或复用磁盘缓存"""
+        rows_per_page = self.rows_per_page if paginate else 0
+        key = (name, rows_per_page)
+        pages = self._pages.get(key)
+        if pages is None:
+            pages = await self._flight.do(
+                key, lambda: self.io_runner.run("thumbnail", self._build, name, rows_per_page)
+            )
+            self._pages[key] = pages
+        return pages
+
+    def _params_digest(self, rows_per_page):
+        params = f"{self.image_format}:{self.quality}:{self.max_width}x{self.max_height}:{self.max_bytes}:{rows_per_page}"
+        return hashlib.sha256(params.encode("utf-8")).hexdigest()[:8]
+
+    def _build(self, name, rows_per_page):
+        """生成缩略图（阻塞，应通过 io_runner 调用）"""
+        with open(os.path.join(self.list_dir, name), "rb") as f:
+            raw = f.read()
+        stem = os.path.splitext(name)[0]
+        source_digest = hashlib.sha256(raw).hexdigest()[:16]
+        prefix = f"{stem}.{source_digest}.{self._params_digest(rows_per_page)}."
+        os.makedirs(self.cache_dir, exist_ok=True)
+        existing = sorted(
+            entry for entry in os.listdir(self.cache_dir)
+            if entry.startswith(prefix) and entry.endswith(f".{self.extension}")
+        )
+        # 文件名带总页数，只复用完整的一组
+        if existing and len(existing) == int(existing[0].rsplit("-", 1)[1].split(".")[0]):
+            self.stats["reused"] += 1
+            return [os.path.join(self.cache_dir, entry) for entry in existing]
+        # 源图或参数变化后，清理该图旧的缩略图（当前参数下分页与不分页的两组都保留）
+        current = tuple(
+            f"{stem}.{source_digest}.{self._params_digest(rows)}." for rows in {0, self.rows_per_page}
+        )
+        for entry in os.listdir(self.cache_dir):
+            if entry.startswith(f"{stem}.") and not entry.startswith(current):
+                os.remove(os.path.join(self.cache_dir, entry))
+
+        with Image.open(io.BytesIO(raw)) as source:
+            image = source.convert("RGB")
+        pages = self._paginate(image, rows_per_page)
+        paths = []
+        for index, page in enumerate(pages):
+            page.thumbnail((self.max_width, self.max_height), Image.LANCZOS)
+            data = self._encode(page)
+            path = os.path.join(self.cache_dir, f"{prefix}p{index:02d}-{len(pages):02d}.{self.extension}")
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            paths.append(path)
+            self.stats["sheet_bytes"] += len(data)
+        self.stats["built"] += 1
+        self.stats["source_bytes"] += len(raw)
+        return paths
+
+    def _encode(self, image):
+        quality = self.quality
+        while True:
+            buffer = io.BytesIO()
+            image.save(buffer, format=self.image_format.upper(), quality=quality, optimize=True)
+            if buffer.tell() <= self.max_bytes or quality <= 40:
+                return buffer.getvalue()
+            quality -= 10
+
+    def _paginate(self, image, rows_per_page):
+        """按行切分图片，每页 rows_per_page 行；未开启分页或检测不到多行时返回整张图"""
+        if rows_per_page <= 0:
+            return [image]
+        rows = self._detect_rows(image)
+        if len(rows) <= rows_per_page:
+            return [image]
+        pages = []
+        for i in range(0, len(rows), rows_per_page):
+            group = rows[i:i + rows_per_page]
+            top = max(0, group[0][0] - 8)
+            bottom = min(image.height, group[-1][1] + 8)
+            pages.append(image.crop((0, top, image.width, bottom)))
+        return pages
+
+    @staticmethod
+    def _detect_rows(image, threshold=24, min_fill=2, min_gap=6):
+        """以左上角像素为背景色，返回内容行的 (起始 y, 结束 y) 列表"""
+        background = Image.new("RGB", image.size, image.getpixel((0, 0)))
+        mask = ImageChops.difference(image, background).convert("L").point(lambda v: 255 if v > threshold else 0)
+        # 缩成一列后每个像素是该行内容像素的占比
+        profile = mask.resize((1, image.height), Image.BOX).tobytes()
+        rows = []
+        start = end = None
+        gap = 0
+        for y, fill in enumerate(profile):
+            if fill >= min_fill:
+                if start is None:
+                    start = y
+                end = y
+                gap = 0
+            elif start is not None:
+                gap += 1
+                if gap >= min_gap:
+                    rows.append((start, end))
+                    start = None
+        if start is not None:
+            rows.append((start, end))
+        return rows
+
+
+class LocalRenderer:
+    """基于 Pillow 的本地贴纸渲染器，在线程池中把文字叠加到本地底图上
+
+    底图目录结构与素材仓库一致（pjsk/<角色>/<角色>_<样式>.png、arcaea/<角色>/<文件>.png），
+    字体对象与解码后的底图均会缓存。
+    """
+
+    def __init__(self, base_image_dir, font_path, font_size=48, min_font_size=12,
+                 text_color="#333333", stroke_color="#FFFFFF", workers=2, max_cached_images=64):
+        self.base_image_dir = base_image_dir
+        self.font_path = font_path
+        self.font_size = font_size
+        self.min_font_size = min_font_size
+        self.text_color = text_color
+        self.stroke_color = stroke_color
+        self.max_cached_images = max_cached_images
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pjsk-render")
+        self._fonts = {}
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"rendered": 0, "missing_base_image": 0}
+
+    def _get_font(self, size):
+        with self._lock:
+            font = self._fonts.get(size)
+            if font is None:
+                font = ImageFont.truetype(self.font_path, size)
+                self._fonts[size] = font
+            return font
+
+    def _get_base_image(self, base_image_path):
+        """读取并缓存解码后的 RGBA 底图，底图不存在时返回 None"""
+        with self._lock:
+            image = self._images.get(base_image_path)
+            if image is not None:
+                self._images.move_to_end(base_image_path)
+                return image
+        full_path = os.path.join(self.base_image_dir, base_image_path)
+        if not os.path.isfile(full_path):
+            return None
+        with Image.open(full_path) as source:
+            image = source.convert("RGBA")
+        with self._lock:
+            self._images[base_image_path] = image
+            while len(self._images) > self.max_cached_images:
+                self._images.popitem(last=False)
+        return image
+
+    def _fit_font(self, draw, text, max_width):
+        """从配置字号开始逐步缩小，直到文字宽度不超过 max_width"""
+        size = self.font_size
+        while True:
+            font = self._get_font(size)
+            stroke_width = max(2, size // 8)
+            left, _, right, _ = draw.multiline_textbbox(
+                (0, 0), text, font=font, stroke_width=stroke_width, align="center"
+            )
+            if right - left <= max_width or size <= self.min_font_size:
+                return font, stroke_width
+            size = max(self.min_font_size, size - 2)
+
+    def _render_sync(self, base_image_path, character, text):
+        base = self._get_base_image(base_image_path)
+        if base is None:
+            return None
+        image = base.copy()
+        draw = ImageDraw.Draw(image)
+        width, height = image.size
+        font, stroke_width = self._fit_font(draw, text, width * 0.92)
+        draw.multiline_text(
+            (width / 2, height * 0.04),
+            text,
+            font=font,
+            fill=PJSK_CHARACTER_COLORS.get(character, self.text_color),
+            anchor="ma",
+            align="center",
+            stroke_width=stroke_width,
+            stroke_fill=self.stroke_color,
+        )
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    async def render(self, base_image_path, character, text):
+        """在线程池中渲染贴纸，底图缺失时返回 None 以便调用方回退"""
+        loop = asyncio.get_running_loop()
+        image_bytes = await loop.run_in_executor(
+            self._executor, self._render_sync, base_image_path, character, text
+        )
+        if image_bytes is None:
+            self.stats["missing_base_image"] += 1
+        else:
+            self.stats["rendered"] += 1
+        return image_bytes
+
+    def _warm_sync(self, base_image_paths):
+        for base_image_path in base_image_paths:
+            self._get_base_image(base_image_path)
+
+    async def warm(self, base_image_paths):
+        """在渲染线程池中预先解码底图"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._warm_sync, list(base_image_paths))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class MetricsRegistry:
+    """进程内指标：计数器、回调式仪表与延迟直方图，可导出 Prometheus 文本格式
+
+    直方图只保留最近 max_samples 个样本用于计算分位数，计数与总和为全量累计。
+    """
+
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, max_samples=2048):
+        self.max_samples = max_samples
+        self.counters = {}
+        self.callbacks = {}
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def register(self, name, func, kind="gauge", **labels):
+        """注册在导出时才读取的指标，func 返回当前值；kind 为 gauge 或 counter"""
+        self.callbacks[self._key(name, labels)] = (func, kind)
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = {"count": 0, "sum": 0.0, "samples": deque(maxlen=self.max_samples)}
+            self.histograms[key] = histogram
+        histogram["count"] += 1
+        histogram["sum"] += seconds
+        histogram["samples"].append(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def get_counter(self, name, **labels):
+        return self.counters.get(self._key(name, labels), 0)
+
+    def get_histogram(self, name, **labels):
+        """返回 (次数, {分位数: 秒})，没有样本时返回 (0, {})"""
+        histogram = self.histograms.get(self._key(name, labels))
+        if histogram is None or not histogram["samples"]:
+            return 0, {}
+        samples = sorted(histogram["samples"])
+        quantiles = {
+            q: samples[min(len(samples) - 1, int(q * len(samples)))] for q in self.QUANTILES
+        }
+        return histogram["count"], quantiles
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    def render_prometheus(self):
+        """导出 Prometheus 文本格式"""
+        lines = []
+        typed = set()
+
+        def type_line(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            type_line(name, "counter")
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for (name, labels), (func, kind) in sorted(self.callbacks.items(), key=lambda item: item[0]):
+            try:
+                value = func()
+            except Exception:
+                continue
+            type_line(name, kind)
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            type_line(name, "summary")
+            _, quantiles = self.get_histogram(name, **dict(labels))
+            for q, value in quantiles.items():
+                lines.append(f"{name}{self._format_labels(labels, [('quantile', q)])} {value:.6f}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {histogram['sum']:.6f}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+class SamplingProfiler:
+    """采样分析器：后台线程按固定间隔采样事件循环线程的调用栈，统计各函数被采样到的次数"""
+
+    def __init__(self, interval=0.005, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self._thread = None
+        self._stop = threading.Event()
+        self._target_thread_id = None
+        self._self_samples = Counter()
+        self._total_samples = Counter()
+        self.samples = 0
+        self.started_at = 0.0
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, target_thread_id):
+        if self.running:
+            return
+        self._target_thread_id = target_thread_id
+        self._self_samples.clear()
+        self._total_samples.clear()
+        self.samples = 0
+        self.started_at = time.monotonic()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="pjsk-profiler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target_thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            seen = set()
+            depth = 0
+            leaf = True
+            while frame is not None and depth < self.max_depth:
+                code = frame.f_code
+                location = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                if leaf:
+                    self._self_samples[location] += 1
+                    leaf = False
+                if location not in seen:
+                    self._total_samples[location] += 1
+                    seen.add(location)
+                frame = frame.f_back
+                depth += 1
+
+    def stop(self, top=15):
+        """停止采样并返回报告文本"""
+        if not self.running:
+            return None
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        duration = time.monotonic() - self.started_at
+        lines = [f"采样 {self.samples} 次，持续 {duration:.1f} 秒，间隔 {self.interval * 1000:g} ms"]
+        if self.samples:
+            lines.append("自身耗时最多的函数：")
+            for location, count in self._self_samples.most_common(top):
+                lines.append(f"  {count / self.samples:6.1%}  {location}")
+            lines.append("累计耗时最多的函数：")
+            for location, count in self._total_samples.most_common(top):
+                lines.append(f"  {count / self.samples:6.1%}  {location}")
+        return "\n".join(lines)
+
+
+class SessionStore:
+    """有容量上限与空闲超时的会话存储，接口与 dict 保持一致
+
+    超过 max_size 时淘汰最久未活动的会话；空闲超过 idle_timeout 的会话在访问时
+    惰性清理，或由后台任务定期调用 sweep() 清理。同时维护活跃发送者 id 的计数，
+    供消息热路径在计算完整会话 key 之前快速排除无会话的消息。会话以任何方式
+    移除时都会调用 on_remove(key)。
+    """
+
+    def __init__(self, max_size=1000, idle_timeout=300.0, on_remove=None):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.on_remove = on_remove
+        self._sessions = OrderedDict()
+        self._senders = Counter()
+        self.stats = {"evicted": 0, "expired": 0}
+
+    @staticmethod
+    def sender_identifier(sender_id):
+        return "unknown" if sender_id is None else str(sender_id)
+
+    def has_sender(self, sender_id):
+        """判断该发送者是否可能有活跃会话（任意平台）"""
+        return self.sender_identifier(sender_id) in self._senders
+
+    def _is_expired(self, last_active, now):
+        return self.idle_timeout > 0 and now - last_active > self.idle_timeout
+
+    def _drop(self, key):
+        del self._sessions[key]
+        self._release_sender(key)
+
+    def _release_sender(self, key):
+        sender = key[1]
+        self._senders[sender] -= 1
+        if self._senders[sender] <= 0:
+            del self._senders[sender]
+        if self.on_remove is not None:
+            self.on_remove(key)
+
+    def __contains__(self, key):
+        entry = self._sessions.get(key)
+        if entry is None:
+            return False
+        if self._is_expired(entry[1], time.monotonic()):
+            self._drop(key)
+            self.stats["expired"] += 1
+            return False
+        return True
+
+    def __getitem__(self, key):
+        session, _ = self._sessions[key]
+        self._sessions[key] = (session, time.monotonic())
+        self._sessions.move_to_end(key)
+        return session
+
+    def __setitem__(self, key, session):
+        if key not in self._sessions:
+            self._senders[key[1]] += 1
+        self._sessions[key] = (session, time.monotonic())
+        self._sessions.move_to_end(key)
+        while len(self._sessions) > self.max_size:
+            evicted_key, _ = self._sessions.popitem(last=False)
+            self._release_sender(evicted_key)
+            self.stats["evicted"] += 1
+
+    def __delitem__(self, key):
+        self._drop(key)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def clear(self):
+        keys = list(self._sessions)
+        self._sessions.clear()
+        self._senders.clear()
+        if self.on_remove is not None:
+            for key in keys:
+                self.on_remove(key)
+
+    def sweep(self):
+        """清理所有空闲超时的会话，返回清理数量"""
+        now = time.monotonic()
+        expired = [key for key, (_, last_active) in self._sessions.items() if self._is_expired(last_active, now)]
+        for key in expired:
+            self._drop(key)
+        self.stats["expired"] += len(expired)
+        return len(expired)
+
+
+class ListImageCache:
+    """list/ 目录参考图缓存
+
+    缓存的是可直接放入 Comp.Image 的 base64:// URI，按字节数做 LRU 淘汰；
+    支持文件路径发送的平台直接使用文件路径，不占用缓存。
+    """
+
+    def __init__(self, io_runner, list_dir, max_bytes=16 * 1024 * 1024):
+        self.io_runner = io_runner
+        self.list_dir = list_dir
+        self.max_bytes = max_bytes
+        self._available = set()
+        self._uris = OrderedDict()
+        self._bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def scan(self):
+        """扫描 list 目录中存在的图片（阻塞，应通过 io_runner 调用）"""
+        self._available = set(os.listdir(self.list_dir)) if os.path.isdir(self.list_dir) else set()
+
+    def exists(self, name):
+        return name in self._available
+
+    def path(self, name):
+        return os.path.join(self.list_dir, name)
+
+    @staticmethod
+    def _read_uri(path):
+        with open(path, "rb") as f:
+            return to_base64_uri(f.read())
+
+    def _store(self, name, uri):
+        size = len(uri)
+        if size > self.max_bytes:
+            return
+        self._uris[name] = uri
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, evicted = self._uris.popitem(last=False)
+            self._bytes -= len(evicted)
+            self.stats["evictions"] += 1
+
+    async def get_base64_uri(self, name, path=None):
+        """获取图片的 base64:// URI，未缓存时在 IO 线程池中读取并编码
+
+        path 为空时读取 list 目录中的原图，否则读取 path（如生成的缩略图），以 name 作为缓存键。
+        """
+        uri = self._uris.get(name)
+        if uri is not None:
+            self._uris.move_to_end(name)
+            self.stats["hits"] += 1
+            return uri
+        self.stats["misses"] += 1
+        uri = await self.io_runner.run("list_image", self._read_uri, path or self.path(name))
+        if name not in self._uris:
+            self._store(name, uri)
+        return uri
+
+    async def warm(self, entries):
+        """预先加载常用图片到缓存，entries 为 (缓存键, 文件路径)"""
+        for name, path in entries:
+            if name not in self._uris:
+                try:
+                    await self.get_base64_uri(name, path)
+                except OSError as e:
+                    logger.warning(f"预热参考图失败 {name}: {e}")
+
+
+class CharacterRecord:
+    """编译后的角色记录，样式表为各会话共享的只读映射"""
+
+    __slots__ = ("char_id", "name", "styles", "ids", "style_table")
+
+    def __init__(self, char_id, name, styles, ids):
+        self.char_id = char_id
+        self.name = name
+        self.styles = styles
+        self.ids = ids
+        self.style_table = MappingProxyType(dict(zip(ids, styles)))
+
+
+class StickerCatalog:
+    """由 list.json 编译出的只读贴纸目录
+
+    校验只在编译时做一次；编译结果以紧凑的元组/数组形式写入快照，
+    快照按 list.json 的 mtime、大小与 sha256 校验，未变化时启动直接加载快照，跳过 JSON 解析与校验。
+    """
+
+    SNAPSHOT_VERSION = 1
+
+    def __init__(self, packs=(), source_sha256=""):
+        """packs 为 [(pack_name, [(char_id, name, styles, ids), ...]), ...]"""
+        self.source_sha256 = source_sha256
+        self._compact = tuple(packs)
+        pack_index = {}
+        characters = {}
+        style_index = {}
+        for pack_name, records in self._compact:
+            pack_index[pack_name.casefold()] = pack_name
+            pack_characters = {}
+            pack_styles = {}
+            for char_id, name, styles, ids in records:
+                record = CharacterRecord(char_id, name, styles, ids)
+                pack_characters[char_id] = record
+                for id_val, style in record.style_table.items():
+                    pack_styles[id_val] = (name, style)
+            characters[pack_name] = MappingProxyType(pack_characters)
+            style_index[pack_name] = MappingProxyType(pack_styles)
+        self.pack_index = MappingProxyType(pack_index)
+        self.characters = MappingProxyType(characters)
+        self.style_index = MappingProxyType(style_index)
+
+    @property
+    def style_count(self):
+        return sum(len(styles) for styles in self.style_index.values())
+
+    @classmethod
+    def compile(cls, data, source_sha256=""):
+        """校验 list.json 的数据并编译，结构不合法时抛出 CatalogError"""
+        packs = data.get("packs") if isinstance(data, dict) else None
+        if not isinstance(packs, dict):
+            raise CatalogError("缺少 packs 对象")
+        compiled = []
+        for pack_name, pack_data in packs.items():
+            characters = pack_data.get("characters") if isinstance(pack_data, dict) else None
+            if not isinstance(characters, dict):
+                raise CatalogError(f"贴纸包 {pack_name} 缺少 characters 对象")
+            records = []
+            seen_ids = set()
+            for char_id, char_data in characters.items():
+                where = f"{pack_name}/{char_id}"
+                if not isinstance(char_data, dict) or not isinstance(char_data.get("name"), str):
+                    raise CatalogError(f"角色 {where} 缺少 name")
+                styles = char_data.get("styles", [])
+                ids = char_data.get("id", [])
+                if not isinstance(styles, list) or not all(isinstance(style, str) for style in styles):
+                    raise CatalogError(f"角色 {where} 的 styles 必须是字符串列表")
+                if not isinstance(ids, list) or not all(type(id_val) is int and id_val >= 0 for id_val in ids):
+                    raise CatalogError(f"角色 {where} 的 id 必须是非负整数列表")
+                if ids and len(ids) != len(styles):
+                    raise CatalogError(f"角色 {where} 的 id 与 styles 数量不一致")
+                duplicated = seen_ids.intersection(ids)
+                if duplicated:
+                    raise CatalogError(f"贴纸包 {pack_name} 中样式 id 重复: {sorted(duplicated)}")
+                seen_ids.update(ids)
+                records.append((char_id, char_data["name"], tuple(styles), array("I", ids)))
+            compiled.append((pack_name, tuple(records)))
+        return cls(compiled, source_sha256)
+
+    @classmethod
+    def load(cls, json_path, snapshot_path=None):
+        """加载目录（阻塞，应通过 io_runner 调用），返回 (目录, 是否来自快照)"""
+        stat = os.stat(json_path)
+        snapshot = cls._read_snapshot(snapshot_path) if snapshot_path else None
+        if snapshot is not None and (snapshot["mtime_ns"], snapshot["size"]) == (stat.st_mtime_ns, stat.st_size):
+            return cls(snapshot["packs"], snapshot["sha256"]), True
+        with open(json_path, "rb") as f:
+            raw = f.read()
+        sha256 = hashlib.sha256(raw).hexdigest()
+        if snapshot is not None and snapshot["sha256"] == sha256:
+            # 内容未变，只是 mtime 变化
+            catalog, from_snapshot = cls(snapshot["packs"], sha256), True
+        else:
+            catalog, from_snapshot = cls.compile(json.loads(raw), sha256), False
+        if snapshot_path:
+            try:
+                catalog._write_snapshot(snapshot_path, stat)
+            except OSError as e:
+                logger.warning(f"写入贴纸目录快照失败: {e}")
+        return catalog, from_snapshot
+
+    @classmethod
+    def _read_snapshot(cls, path):
+        try:
+            with open(path, "rb") as f:
+                snapshot = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"贴纸目录快照损坏，将重新编译: {e}")
+            return None
+        if not isinstance(snapshot, dict) or snapshot.get("version") != cls.SNAPSHOT_VERSION:
+            return None
+        return snapshot
+
+    def _write_snapshot(self, path, stat):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump({
+                "version": self.SNAPSHOT_VERSION,
+                "mtime_ns": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "sha256": self.source_sha256,
+                "packs": self._compact,
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+
+@register(PLUGIN_NAME, "kamicry", "pjsk表情包生成器", "v1.2.1")
 class StickerPlugin(Star):
     def __init__(self, context: Context, config: AstrBotConfig = None):
         super().__init__(context)
         self.config = config or {}
-        self.sessions = {}
-        self.list_data = {}
+        session_conf = self._get_config_section("session")
+        self.sessions = SessionStore(
+            max_size=session_conf.get("max_sessions", 1000),
+            idle_timeout=session_conf.get("idle_timeout", 300.0),
+            on_remove=self._cancel_prefetch,
+        )
+        self.prefetch_enabled = self._get_config_section("prefetch").get("enabled", True)
+        self._prefetch_tasks = {}
+        self.session_sweep_interval = session_conf.get("sweep_interval", 60.0)
+        self._session_sweeper = None
+        self._platform_identifiers = {}
+        batch_conf = self._get_config_section("batch")
+        self.batch_max_items = batch_conf.get("max_items", 10)
+        self.batch_concurrency = batch_conf.get("concurrency", 4)
+        rate_limit_conf = self._get_config_section("rate_limit")
+        self.rate_limit_enabled = rate_limit_conf.get("enabled", True)
+        self.rate_limit_exempt_admins = rate_limit_conf.get("exempt_admins", True)
+        self.queue_notice = rate_limit_conf.get("queue_notice", True)
+        self.user_limiter = self._create_limiter(
+            rate_limit_conf.get("user_per_minute", 10), rate_limit_conf.get("user_burst", 5)
+        )
+        self.group_limiter = self._create_limiter(
+            rate_limit_conf.get("group_per_minute", 40), rate_limit_conf.get("group_burst", 20)
+        )
+        self.catalog = StickerCatalog()
+        self.list_json_path = os.path.join(os.path.dirname(__file__), "list.json")
+        catalog_conf = self._get_config_section("catalog")
+        self.catalog_snapshot_enabled = catalog_conf.get("snapshot_enabled", True)
+        self.catalog_watch = catalog_conf.get("watch", False)
+        self.catalog_watch_interval = catalog_conf.get("watch_interval", 5.0)
+        self._catalog_watcher = None
+        self._catalog_lock = asyncio.Lock()
         self.list_dir = os.path.join(os.path.dirname(__file__), "list")
-        self.image_cache = {}
+        self.io_runner = BlockingIoRunner(workers=self._get_config_section("io").get("workers", 2))
+        list_image_conf = self._get_config_section("list_image")
+        self.list_image_cache = ListImageCache(
+            self.io_runner,
+            self.list_dir, max_bytes=int(list_image_conf.get("cache_max_mb", 16) * 1024 * 1024)
+        )
+        self.list_image_prewarm = list_image_conf.get("prewarm", True)
+        self.file_platforms = set(self._get_config_section("delivery").get("file_platforms", []))
+        self.thumbnails = None
+        self._list_image_prewarm_task = None
+        self.http_client = None
+        self.render_client = None
+        self.sticker_cache = None
+        self.render_flight = SingleFlight()
+        self.local_renderer = None
+        metrics_conf = self._get_config_section("metrics")
+        self.metrics = MetricsRegistry(max_samples=metrics_conf.get("max_samples", 2048))
+        self.metrics_file = metrics_conf.get("prometheus_file", "")
+        self.metrics_dump_interval = metrics_conf.get("dump_interval", 60.0)
+        self._metrics_dumper = None
+        # 全局消息监听器的计数直接用整数累加，导出时再读取，不给热路径增加开销
+        self._messages_seen = 0
+        self._messages_skipped = 0
+        self.profiler_enabled = metrics_conf.get("profiler_enabled", False)
+        self.profiler = SamplingProfiler(interval=metrics_conf.get("profiler_interval_ms", 5) / 1000)
+        self._register_metrics()
 
         # 从配置读取 API URL，默认不提供
         self.api_url = self.config.get("api_url", "") if isinstance(self.config, dict) else ""
@@ -26,14 +1448,402 @@ class StickerPlugin(Star):
         
     async def initialize(self):
         """插件初始化，加载list.json数据"""
+        self.thumbnails = self._create_thumbnail_cache()
         try:
-            list_json_path = os.path.join(os.path.dirname(__file__), "list.json")
-            with open(list_json_path, 'r', encoding='utf-8') as f:
-                self.list_data = json.load(f)
-            logger.info("贴纸数据加载成功")
+            await self._reload_catalog()
         except Exception as e:
             logger.error(f"加载贴纸数据失败: {e}")
-            
+        if self.list_image_prewarm:
+            self._list_image_prewarm_task = asyncio.create_task(self._prewarm_list_images())
+
+        self.http_client = self._create_http_client()
+        self.render_client = self._create_render_client()
+        self.sticker_cache = await self._create_sticker_cache()
+        self.local_renderer = self._create_local_renderer()
+        self._session_sweeper = asyncio.create_task(self._sweep_sessions())
+        if self.metrics_file:
+            self._metrics_dumper = asyncio.create_task(self._dump_metrics())
+        if self.catalog_watch:
+            self._catalog_watcher = asyncio.create_task(self._watch_catalog())
+
+    @staticmethod
+    def _create_limiter(per_minute, burst):
+        """每分钟恢复次数或突发上限不大于 0 时不限制该范围"""
+        if per_minute <= 0 or burst <= 0:
+            return None
+        return TokenBucketLimiter(rate=per_minute / 60, burst=burst)
+
+    def _get_group_key(self, event: AstrMessageEvent):
+        """群聊返回 (平台, "group", 群号)，私聊返回 None"""
+        group_id = event.get_group_id()
+        if not group_id:
+            return None
+        return self._get_session_key(event)[0], "group", group_id
+
+    def _get_queue_key(self, event: AstrMessageEvent):
+        """渲染排队的公平调度 key：群聊按群，私聊按用户"""
+        return self._get_group_key(event) or self._get_session_key(event)
+
+    def _count_renders(self, pack, stickers):
+        """需要真正渲染的张数：相同贴纸只渲染一次，命中缓存的不占用渲染服务，不计入限流"""
+        urls = {self._build_sticker_url(pack, character, style, text) for character, style, text in stickers}
+        if self.sticker_cache is not None:
+            urls = {url for url in urls if not self.sticker_cache.contains(url)}
+        return len(urls)
+
+    def _check_rate_limit(self, event: AstrMessageEvent, cost=1):
+        """用户与群两级令牌桶限流，放行时扣除令牌并返回 0，否则返回需要等待的秒数"""
+        if cost <= 0 or not self.rate_limit_enabled or (self.rate_limit_exempt_admins and event.is_admin()):
+            return 0.0
+        scopes = []
+        if self.user_limiter is not None:
+            scopes.append(("user", self.user_limiter, self._get_session_key(event)))
+        group_key = self._get_group_key(event)
+        if self.group_limiter is not None and group_key is not None:
+            scopes.append(("group", self.group_limiter, group_key))
+        wait, scope = max(((limiter.wait_time(key, cost), name) for name, limiter, key in scopes), default=(0.0, None))
+        if wait > 0:
+            self.metrics.inc("pjsk_sticker_throttled_total", scope=scope)
+            return wait
+        for _, limiter, key in scopes:
+            limiter.consume(key, cost)
+        return 0.0
+
+    def _get_queue_position(self, queue_key, pack, character, style_id, text):
+        """估算这次渲染在渲染 API 队列中的位置，命中缓存或启用本地渲染时返回 0"""
+        if not self.queue_notice or self.render_client is None or self.local_renderer is not None:
+            return 0
+        if self.sticker_cache is not None and self.sticker_cache.contains(
+            self._build_sticker_url(pack, character, style_id, text)
+        ):
+            return 0
+        return self.render_client.scheduler.position(queue_key)
+
+    def _get_catalog_snapshot_path(self):
+        if not self.catalog_snapshot_enabled:
+            return None
+        return os.path.join(str(StarTools.get_data_dir(PLUGIN_NAME)), "catalog.pickle")
+
+    async def _reload_catalog(self):
+        """在 IO 线程池中加载并编译 list.json，成功后整体替换当前目录，返回新目录
+
+        替换只是一次属性赋值，进行中的会话仍引用旧目录中的样式表，不受影响；
+        加载失败时抛出异常并保留旧目录。
+        """
+        async with self._catalog_lock:
+            start = time.perf_counter()
+            try:
+                catalog, from_snapshot = await self.io_runner.run(
+                    "catalog", StickerCatalog.load, self.list_json_path, self._get_catalog_snapshot_path()
+                )
+            except Exception:
+                self.metrics.inc("pjsk_sticker_catalog_loads_total", result="error")
+                raise
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self.catalog = catalog
+            self.metrics.inc("pjsk_sticker_catalog_loads_total", result="snapshot" if from_snapshot else "compiled")
+            logger.info(
+                f"贴纸目录加载完成（{'快照' if from_snapshot else '编译 list.json'}）: "
+                f"{len(catalog.pack_index)} 个贴纸包，{catalog.style_count} 个样式，"
+                f"耗时 {elapsed_ms:.2f} ms（IO 线程池中执行）"
+            )
+            await self._check_list_images()
+            return catalog
+
+    async def _watch_catalog(self):
+        """后台轮询 list.json 的修改时间，变化时自动重新加载"""
+        last_mtime = None
+        while True:
+            try:
+                mtime = (await self.io_runner.run("catalog_stat", os.stat, self.list_json_path)).st_mtime_ns
+                if last_mtime is not None and mtime != last_mtime:
+                    await self._reload_catalog()
+                last_mtime = mtime
+            except Exception as e:
+                logger.warning(f"自动重新加载贴纸目录失败，继续使用当前目录: {e}")
+            await asyncio.sleep(self.catalog_watch_interval)
+
+    def _get_config_section(self, name):
+        """读取对象类型的配置项，缺失时返回空字典"""
+        if not isinstance(self.config, dict):
+            return {}
+        section = self.config.get(name, {})
+        return section if isinstance(section, dict) else {}
+
+    async def _sweep_sessions(self):
+        """后台定期清理空闲超时的会话"""
+        while True:
+            await asyncio.sleep(self.session_sweep_interval)
+            expired = self.sessions.sweep()
+            if expired:
+                logger.info(f"已清理 {expired} 个空闲超时的贴纸会话，当前活跃会话 {len(self.sessions)} 个")
+
+    def _register_metrics(self):
+        """注册从各组件现有统计中读取的指标，导出时才取值"""
+        m = self.metrics
+        prefix = "pjsk_sticker_"
+        m.register(prefix + "messages_total", lambda: self._messages_seen, kind="counter")
+        m.register(prefix + "messages_skipped_total", lambda: self._messages_skipped, kind="counter")
+        m.register(prefix + "sessions_active", lambda: len(self.sessions))
+        m.register(prefix + "catalog_styles", lambda: self.catalog.style_count)
+        m.register(prefix + "sessions_evicted_total", lambda: self.sessions.stats["evicted"], kind="counter")
+        m.register(prefix + "sessions_expired_total", lambda: self.sessions.stats["expired"], kind="counter")
+        m.register(prefix + "render_coalesced_total", lambda: self.render_flight.stats["coalesced"], kind="counter")
+        m.register(prefix + "render_inflight", lambda: self.render_flight.inflight)
+        for name in ("memory_hits", "disk_hits", "misses"):
+            m.register(
+                prefix + "cache_lookups_total",
+                lambda name=name: self.sticker_cache.stats[name] if self.sticker_cache is not None else 0,
+                kind="counter", result=name,
+            )
+        for name in ("hits", "misses"):
+            m.register(
+                prefix + "list_image_lookups_total",
+                lambda name=name: self.list_image_cache.stats[name], kind="counter", result=name,
+            )
+        m.register(prefix + "api_waiting", lambda: self.render_client.waiting if self.render_client else 0)
+        m.register(prefix + "api_active", lambda: self.render_client.active if self.render_client else 0)
+        m.register(
+            prefix + "api_queued_keys", lambda: self.render_client.scheduler.queued_keys if self.render_client else 0
+        )
+        # 0 正常，1 熔断，2 半开
+        m.register(
+            prefix + "api_breaker_state",
+            lambda: (CircuitBreaker.CLOSED, CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN).index(
+                self.render_client.breaker.state
+            ) if self.render_client else 0,
+        )
+        for name in ("requests", "retries", "failures", "timeouts", "queue_timeouts"):
+            m.register(
+                prefix + f"api_{name}_total",
+                lambda name=name: self.render_client.stats[name] if self.render_client else 0,
+                kind="counter",
+            )
+        for name in ("connections_opened", "connections_reused"):
+            m.register(
+                prefix + f"http_{name}_total",
+                lambda name=name: self.http_client.stats[name] if self.http_client else 0,
+                kind="counter",
+            )
+
+    def _format_stats(self):
+        """生成 /draw stats 的文本"""
+        m = self.metrics
+        lines = ["📊 贴纸插件运行统计"]
+        histograms = [
+            ("获取贴纸", "pjsk_sticker_fetch_seconds", {}),
+            ("本地渲染", "pjsk_sticker_render_seconds", {"source": "local"}),
+            ("渲染 API", "pjsk_sticker_render_seconds", {"source": "api"}),
+            ("构建 URL", "pjsk_sticker_build_url_seconds", {}),
+            ("参考图加载", "pjsk_sticker_list_image_seconds", {}),
+        ]
+        for step in ("select_pack", "select_character", "select_style", "input_text"):
+            histograms.append((f"会话步骤 {step}", "pjsk_sticker_session_step_seconds", {"step": step}))
+        for title, name, labels in histograms:
+            count, quantiles = m.get_histogram(name, **labels)
+            if count:
+                p50, p95, p99 = (quantiles[q] * 1000 for q in MetricsRegistry.QUANTILES)
+                lines.append(f"{title}：{count} 次，p50 {p50:.2f} / p95 {p95:.2f} / p99 {p99:.2f} ms")
+        api_responses = sum(
+            value for (name, _), value in m.counters.items() if name == "pjsk_sticker_upstream_responses_total"
+        )
+        api_errors = api_responses - m.get_counter("pjsk_sticker_upstream_responses_total", status=200)
+        if api_responses:
+            lines.append(f"渲染 API 错误率：{api_errors / api_responses:.1%}（{api_errors}/{api_responses}）")
+        if self.sticker_cache is not None:
+            cache_stats = self.sticker_cache.stats
+            hits = cache_stats["memory_hits"] + cache_stats["disk_hits"]
+            lookups = hits + cache_stats["misses"]
+            if lookups:
+                lines.append(f"贴纸缓存命中率：{hits / lookups:.1%}（{hits}/{lookups}）")
+        lines.append(
+            f"会话：活跃 {len(self.sessions)} 个，容量淘汰 {self.sessions.stats['evicted']} 个，"
+            f"超时清理 {self.sessions.stats['expired']} 个"
+        )
+        messages = self._messages_seen
+        skipped = self._messages_skipped
+        lines.append(f"消息处理器：收到 {messages} 条，快速路径跳过 {skipped} 条")
+        lines.append(
+            f"限流：用户 {m.get_counter('pjsk_sticker_throttled_total', scope='user')} 次，"
+            f"群 {m.get_counter('pjsk_sticker_throttled_total', scope='group')} 次"
+        )
+        lines.append(
+            f"合并并发请求：{self.render_flight.stats['coalesced']} 次，进行中 {self.render_flight.inflight} 个"
+        )
+        return "\n".join(lines)
+
+    def _write_metrics_file(self, text):
+        """原子写入 Prometheus 文本文件（阻塞，应通过 io_runner 调用）"""
+        tmp_path = f"{self.metrics_file}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, self.metrics_file)
+
+    async def _dump_metrics(self):
+        """后台定期将指标导出到 Prometheus 文本文件，供 node_exporter textfile 等方式采集"""
+        while True:
+            await asyncio.sleep(self.metrics_dump_interval)
+            try:
+                await self.io_runner.run("metrics_dump", self._write_metrics_file, self.metrics.render_prometheus())
+            except OSError as e:
+                logger.warning(f"导出指标文件失败 {self.metrics_file}: {e}")
+
+    def _create_http_client(self):
+        """根据 http 配置创建共享的连接池客户端"""
+        http_conf = self._get_config_section("http")
+        client = PooledHttpClient(
+            max_connections=http_conf.get("max_connections", 20),
+            max_keepalive_connections=http_conf.get("max_keepalive_connections", 10),
+            keepalive_expiry=http_conf.get("keepalive_expiry", 30.0),
+            connect_timeout=http_conf.get("connect_timeout", 5.0),
+            read_timeout=http_conf.get("read_timeout", 30.0),
+            http2=http_conf.get("http2", True),
+            max_response_bytes=int(http_conf.get("max_response_mb", 10) * 1024 * 1024),
+        )
+        logger.info(f"贴纸渲染 HTTP 客户端已创建 (HTTP/2: {client.http2})")
+        return client
+
+    def _create_render_client(self):
+        """根据 resilience 配置为共享客户端加上并发限制、重试与熔断"""
+        resilience_conf = self._get_config_section("resilience")
+        return ResilientRenderClient(
+            self._get_http_client(),
+            max_concurrency=resilience_conf.get("max_concurrency", 8),
+            deadline=resilience_conf.get("deadline", 45.0),
+            max_retries=resilience_conf.get("max_retries", 2),
+            retry_backoff=resilience_conf.get("retry_backoff", 0.5),
+            breaker=CircuitBreaker(
+                failure_threshold=resilience_conf.get("breaker_failure_threshold", 5),
+                recovery_timeout=resilience_conf.get("breaker_recovery_timeout", 30.0),
+            ),
+        )
+
+    async def _create_sticker_cache(self):
+        """根据 cache 配置创建渲染结果缓存，未启用时返回 None"""
+        cache_conf = self._get_config_section("cache")
+        if not cache_conf.get("enabled", True):
+            return None
+        disk_dir = None
+        if cache_conf.get("disk_enabled", False):
+            disk_dir = os.path.join(str(StarTools.get_data_dir(PLUGIN_NAME)), "sticker_cache")
+        cache = StickerCache(
+            self.io_runner,
+            memory_max_bytes=int(cache_conf.get("memory_max_mb", 32) * 1024 * 1024),
+            disk_dir=disk_dir,
+            disk_max_bytes=int(cache_conf.get("disk_max_mb", 256) * 1024 * 1024),
+            disk_ttl=cache_conf.get("disk_ttl_hours", 168) * 3600,
+        )
+        if disk_dir:
+            try:
+                await cache.load_disk_index()
+            except OSError as e:
+                logger.warning(f"初始化贴纸磁盘缓存失败，仅使用内存缓存: {e}")
+                cache.disk_dir = None
+        return cache
+
+    def _create_thumbnail_cache(self):
+        """根据 thumbnail 配置创建参考图缩略图缓存，未启用或未安装 Pillow 时返回 None（发送原图）"""
+        thumbnail_conf = self._get_config_section("thumbnail")
+        if not thumbnail_conf.get("enabled", True):
+            return None
+        if not PIL_AVAILABLE:
+            logger.info("未安装 Pillow，参考图将以原图发送")
+            return None
+        return ThumbnailSheetCache(
+            self.io_runner,
+            self.list_dir,
+            os.path.join(str(StarTools.get_data_dir(PLUGIN_NAME)), "thumbnails"),
+            image_format=thumbnail_conf.get("format", "webp"),
+            quality=thumbnail_conf.get("quality", 80),
+            max_width=thumbnail_conf.get("max_width", 1024),
+            max_height=thumbnail_conf.get("max_height", 1280),
+            max_bytes=int(thumbnail_conf.get("max_kb", 300) * 1024),
+            rows_per_page=thumbnail_conf.get("style_rows_per_page", 0),
+        )
+
+    def _create_local_renderer(self):
+        """根据 render 配置创建本地渲染器，未启用或条件不满足时返回 None"""
+        render_conf = self._get_config_section("render")
+        if not render_conf.get("local_enabled", False):
+            return None
+        if not PIL_AVAILABLE:
+            logger.warning("未安装 Pillow，本地渲染已禁用，将继续使用渲染 API")
+            return None
+        font_path = render_conf.get("font_path", "")
+        if not font_path or not os.path.isfile(font_path):
+            logger.warning(f"本地渲染字体文件不存在: {font_path!r}，本地渲染已禁用")
+            return None
+        base_image_dir = render_conf.get("base_image_dir", "") or os.path.join(
+            str(StarTools.get_data_dir(PLUGIN_NAME)), "base_images"
+        )
+        renderer = LocalRenderer(
+            base_image_dir=base_image_dir,
+            font_path=font_path,
+            font_size=render_conf.get("font_size", 48),
+            min_font_size=render_conf.get("min_font_size", 12),
+            text_color=render_conf.get("text_color", "#333333"),
+            stroke_color=render_conf.get("stroke_color", "#FFFFFF"),
+            workers=render_conf.get("workers", 2),
+            max_cached_images=render_conf.get("max_cached_images", 64),
+        )
+        logger.info(f"本地渲染已启用，底图目录: {base_image_dir}")
+        return renderer
+
+    async def _fetch_sticker(self, pack, character, style_id, text, queue_key=None):
+        """获取渲染好的贴纸，优先命中缓存，返回 (状态码, 图片字节)；queue_key 用于渲染 API 的公平排队"""
+        with self.metrics.timer("pjsk_sticker_build_url_seconds"):
+            url = self._build_sticker_url(pack, character, style_id, text)
+        with self.metrics.timer("pjsk_sticker_fetch_seconds"):
+            if self.sticker_cache is not None:
+                cached = await self.sticker_cache.get(url)
+                if cached is not None:
+                    return 200, cached
+            # 相同 URL 的并发请求只渲染一次
+            return await self.render_flight.do(
+                url, lambda: self._fetch_sticker_upstream(url, pack, character, style_id, text, queue_key)
+            )
+
+    async def _fetch_sticker_upstream(self, url, pack, character, style_id, text, queue_key=None):
+        """优先本地渲染，底图缺失时请求渲染 API，结果写入缓存，返回 (状态码, 图片字节)"""
+        image_bytes = None
+        if self.local_renderer is not None:
+            base_image_path = self._get_base_image_path(pack, character, style_id)
+            try:
+                with self.metrics.timer("pjsk_sticker_render_seconds", source="local"):
+                    image_bytes = await self.local_renderer.render(base_image_path, character, text)
+            except Exception as e:
+                self.metrics.inc("pjsk_sticker_local_render_errors_total")
+                logger.warning(f"本地渲染失败，回退至渲染 API: {e}")
+        if image_bytes is None:
+            with self.metrics.timer("pjsk_sticker_render_seconds", source="api"):
+                status_code, image_bytes = await self._get_render_client().get(url, queue_key)
+            self.metrics.inc("pjsk_sticker_upstream_responses_total", status=status_code)
+            if status_code != 200:
+                return status_code, None
+        if self.sticker_cache is not None:
+            await self.sticker_cache.put(url, image_bytes)
+        return 200, image_bytes
+
+    def _get_http_client(self):
+        """获取共享的 HTTP 客户端，未初始化时按需创建"""
+        if self.http_client is None:
+            self.http_client = self._create_http_client()
+        return self.http_client
+
+    def _build_sticker_image(self, event: AstrMessageEvent, image_bytes, pack, character, style_id, text):
+        """构建贴纸图片组件：支持文件路径的平台直接使用磁盘缓存文件，否则编码为 base64"""
+        if self.sticker_cache is not None and event.get_platform_name() in self.file_platforms:
+            path = self.sticker_cache.disk_path(self._build_sticker_url(pack, character, style_id, text))
+            if path is not None:
+                return Comp.Image.fromFileSystem(path)
+        return Comp.Image(file=to_base64_uri(image_bytes))
+
+    def _get_render_client(self):
+        """获取带重试与熔断的渲染 API 客户端，未初始化时按需创建"""
+        if self.render_client is None:
+            self.render_client = self._create_render_client()
+        return self.render_client
+
     def _get_session_key(self, event: AstrMessageEvent):
         """获取会话key，使用(platform, sender_id)元组"""
         message_obj = getattr(event, "message_obj", None)
@@ -45,61 +1855,169 @@ class StickerPlugin(Star):
                 platform = getattr(inner, "platform", None) if inner is not None else None
         if platform is None:
             platform = getattr(event, "platform", None)
-        platform_identifier = "default"
-        if platform is not None:
-            platform_identifier = str(getattr(platform, "name", platform))
-        sender_id = event.get_sender_id()
-        sender_identifier = "unknown" if sender_id is None else str(sender_id)
+        platform_identifier = self._resolve_platform_identifier(platform)
+        sender_identifier = SessionStore.sender_identifier(event.get_sender_id())
         return (platform_identifier, sender_identifier)
+
+    def _resolve_platform_identifier(self, platform):
+        """把平台对象解析为标识字符串；平台对象长期存在，按对象缓存解析结果"""
+        if platform is None:
+            return "default"
+        cached = self._platform_identifiers.get(id(platform))
+        if cached is not None and cached[0] is platform:
+            return cached[1]
+        identifier = str(getattr(platform, "name", platform))
+        if len(self._platform_identifiers) >= 64:
+            self._platform_identifiers.clear()
+        self._platform_identifiers[id(platform)] = (platform, identifier)
+        return identifier
     
+    def _match_pack(self, name):
+        """不区分大小写匹配贴纸包名，不存在时返回 None"""
+        return self.catalog.pack_index.get(name.casefold())
+
     def _get_all_packs(self):
         """获取所有可用的pack列表"""
-        return list(self.list_data.get("packs", {}).keys())
+        return list(self.catalog.characters)
     
     def _get_characters_in_pack(self, pack_name):
-        """获取指定pack中的所有角色"""
-        pack_data = self.list_data.get("packs", {}).get(pack_name, {})
-        characters = pack_data.get("characters", {})
-        return characters
+        """获取指定pack中的所有角色，返回 角色序号 -> CharacterRecord"""
+        return self.catalog.characters.get(pack_name, {})
     
     def _find_character_by_style_id(self, pack_name, style_id):
         """根据样式ID查找对应的角色和样式"""
-        characters = self._get_characters_in_pack(pack_name)
-        
-        for char_id, char_data in characters.items():
-            char_styles = char_data["styles"]
-            char_ids = char_data["id"]
-            
-            # 创建id到style的映射
-            id_to_style = {id_val: style for id_val, style in zip(char_ids, char_styles)}
-            
-            if style_id in id_to_style:
-                character_name = char_data["name"]
-                style = id_to_style[style_id]
-                return (character_name, style)
-        
-        return None
+        return self.catalog.style_index.get(pack_name, {}).get(style_id)
     
-    def _load_image_as_base64(self, image_name):
-        """加载图片并转换为base64"""
-        if image_name in self.image_cache:
-            return self.image_cache[image_name]
-        
+    async def _check_list_images(self):
+        """扫描 list 目录，缺失的参考图只在加载时记录一次，并按配置在后台预热高频图片"""
+        await self.io_runner.run("list_scan", self.list_image_cache.scan)
+        if self.thumbnails is not None:
+            self.thumbnails.invalidate()
+        expected = ["characterListAll.jpeg", *HOT_LIST_IMAGES]
+        pjsk_characters = self._get_characters_in_pack("pjsk")
+        expected.extend(f"{record.name}.jpeg" for record in pjsk_characters.values())
+        missing = [name for name in expected if not self.list_image_cache.exists(name)]
+        if missing:
+            logger.warning(f"以下参考图不存在，将跳过发送: {', '.join(missing)}")
+
+    async def _resolve_list_image(self, image_name, paginate=False):
+        """返回参考图各页的 (缓存键, 文件路径)，启用缩略图时为生成的缩略图，否则为原图"""
+        if self.thumbnails is not None:
+            try:
+                paths = await self.thumbnails.get_pages(image_name, paginate)
+                return [(os.path.basename(path), path) for path in paths]
+            except Exception as e:
+                logger.warning(f"生成缩略图失败，改为发送原图 {image_name}: {e}")
+        return [(image_name, self.list_image_cache.path(image_name))]
+
+    async def _warm_list_images(self, names):
+        """预先生成常用参考图的缩略图并加载到缓存"""
+        for name in names:
+            if self.list_image_cache.exists(name):
+                await self.list_image_cache.warm(await self._resolve_list_image(name))
+
+    async def _prewarm_list_images(self):
+        """启动时预热常用参考图，并在后台预先生成所有角色样式表的缩略图（只写磁盘，不占内存缓存）"""
+        await self._warm_list_images(HOT_LIST_IMAGES)
+        if self.thumbnails is None:
+            return
+        for record in self._get_characters_in_pack("pjsk").values():
+            name = f"{record.name}.jpeg"
+            if self.list_image_cache.exists(name):
+                try:
+                    await self.thumbnails.get_pages(name, paginate=True)
+                except Exception as e:
+                    logger.warning(f"预先生成缩略图失败 {name}: {e}")
+
+    async def _count_list_image_pages(self, image_name):
+        """样式表分页后的页数，参考图不存在时返回 0"""
+        if not self.list_image_cache.exists(image_name):
+            return 0
+        return len(await self._resolve_list_image(image_name, paginate=True))
+
+    async def _get_list_image(self, event: AstrMessageEvent, image_name, page=None):
+        """获取参考图消息组件，支持的平台直接发送文件路径，否则发送缓存的 base64
+
+        page 为空时发送整张图，否则发送分页样式表的第 page 页（从 0 开始）。
+        """
+        if not self.list_image_cache.exists(image_name):
+            return None
         try:
-            image_path = os.path.join(self.list_dir, image_name)
-            if not os.path.exists(image_path):
-                logger.warning(f"图片不存在: {image_path}")
-                return None
-            
-            with open(image_path, 'rb') as f:
-                image_bytes = f.read()
-                image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-                self.image_cache[image_name] = image_base64
-                return image_base64
+            with self.metrics.timer("pjsk_sticker_list_image_seconds"):
+                pages = await self._resolve_list_image(image_name, paginate=page is not None)
+                name, path = pages[(page or 0) % len(pages)]
+                if event.get_platform_name() in self.file_platforms:
+                    return Comp.Image.fromFileSystem(path)
+                return Comp.Image(file=await self.list_image_cache.get_base64_uri(name, path))
         except Exception as e:
             logger.error(f"加载图片失败 {image_name}: {e}")
             return None
     
+    def _parse_id_spec(self, spec, limit):
+        """解析样式 id / 角色序号参数，支持单个数字、a-b 区间与逗号分隔；数量超过 limit 时返回 None"""
+        ids = []
+        for part in spec.split(","):
+            if "-" in part:
+                start, end = (int(value) for value in part.split("-", 1))
+                if end < start:
+                    raise ValueError(f"区间 {part} 无效")
+                if len(ids) + end - start + 1 > limit:
+                    return None
+                ids.extend(range(start, end + 1))
+            else:
+                ids.append(int(part))
+                if len(ids) > limit:
+                    return None
+        return ids
+
+    def _resolve_quick_target(self, pack_name, target_id):
+        """把直接生成模式的数字解析为 (角色名, 样式)：arcaea 为角色序号，pjsk 为样式 id；不存在时返回 None"""
+        if pack_name == "arcaea":
+            record = self._get_characters_in_pack("arcaea").get(str(target_id))
+            if record is None:
+                return None
+            return record.name, record.styles[0] if record.styles else None
+        return self._find_character_by_style_id(pack_name, target_id)
+
+    async def _generate_batch(self, event: AstrMessageEvent, pack_name, targets, texts):
+        """并发生成多张贴纸，按输入顺序合并为一条消息返回
+
+        targets 为 (序号, _resolve_quick_target 的结果) 列表，不存在的序号在结果中提示。
+        """
+        semaphore = asyncio.Semaphore(self.batch_concurrency)
+        label = "角色序号" if pack_name == "arcaea" else "样式ID"
+        queue_key = self._get_queue_key(event)
+
+        async def render(target_id, target, text):
+            if target is None:
+                return f"❌ {label} {target_id} 不存在"
+            character_name, style = target
+            async with semaphore:
+                try:
+                    status_code, image_bytes = await self._fetch_sticker(
+                        pack_name, character_name, style, text, queue_key
+                    )
+                except Exception as e:
+                    logger.error(f"批量生成贴纸时出错: {e}")
+                    return f"❌ {label} {target_id}「{text}」生成失败: {e}"
+            if status_code != 200:
+                return f"❌ {label} {target_id}「{text}」生成失败，状态码: {status_code}"
+            return self._build_sticker_image(event, image_bytes, pack_name, character_name, style, text)
+
+        results = await asyncio.gather(
+            *(render(target_id, target, text) for target_id, target in targets for text in texts)
+        )
+        chain = []
+        succeeded = 0
+        for result in results:
+            if isinstance(result, str):
+                chain.append(Comp.Plain(text=f"{result}\n"))
+            else:
+                chain.append(result)
+                succeeded += 1
+        chain.append(Comp.Plain(text=f"✨ 批量生成完成！成功 {succeeded}/{len(results)} 张"))
+        return event.chain_result(chain)
+
     @filter.command("draw")
     async def start_sticker_session(self, event: AstrMessageEvent):
         """开始贴纸生成会话或处理带参数的命令"""
@@ -122,20 +2040,24 @@ class StickerPlugin(Star):
         
         # 分割参数
         args = message_text.split() if message_text else []
+        subcommand = args[0].lower() if args else "interactive"
+        if subcommand not in ("interactive", "list", "help", "cache", "api", "stats", "profile", "reload"):
+            subcommand = "quick"
+        self.metrics.inc("pjsk_sticker_commands_total", subcommand=subcommand)
 
         # 处理 /draw list 命令
         if len(args) > 0 and args[0].lower() == "list":
-            pjsk_img = self._load_image_as_base64("characterListAll.jpeg")
+            pjsk_img = await self._get_list_image(event, "characterListAll.jpeg")
             if pjsk_img:
                 yield event.chain_result([
                     Comp.Plain(text="PJSK 角色列表："),
-                    Comp.Image(file=f"base64://{pjsk_img}")
+                    pjsk_img
                 ])
-            arcaea_img = self._load_image_as_base64("arcaea_list.jpg")
+            arcaea_img = await self._get_list_image(event, "arcaea_list.jpg")
             if arcaea_img:
                 yield event.chain_result([
                     Comp.Plain(text="Arcaea 角色列表："),
-                    Comp.Image(file=f"base64://{arcaea_img}")
+                    arcaea_img
                 ])
             return
 
@@ -153,69 +2075,186 @@ class StickerPlugin(Star):
     - pjsk: /draw pjsk <样式id> <文字>（样式id: 0~358）
     - arcaea: /draw arcaea <角色序号> <文字>（序号见 arcaea_list.jpg）
 
+    批量生成：
+    - 序号支持区间与逗号分隔：/draw pjsk 10-15 你好、/draw arcaea 1,4,19 你好
+    - 多段文字用 | 分隔：/draw pjsk 42 早上好|晚安
+
     交互式模式退出：
     - 在任何步骤输入 quit 可直接退出贴纸生成器
 
+    管理员命令：
+    - /draw cache - 查看贴纸缓存统计
+    - /draw api - 查看渲染 API 熔断与排队状态
+    - /draw stats - 查看延迟分位数与热路径统计
+    - /draw profile start|stop - 开关采样分析器（需在配置中启用）
+    - /draw reload - 重新加载 list.json（不影响进行中的会话）
+
     例如：/draw pjsk 42 你好"""
             yield event.plain_result(help_text)
             return
 
+        # 处理 /draw cache 命令（仅管理员）
+        if len(args) > 0 and args[0].lower() == "cache":
+            if not event.is_admin():
+                yield event.plain_result("❌ 该命令仅限管理员使用")
+                return
+            if self.sticker_cache is None:
+                yield event.plain_result("贴纸缓存未启用")
+                return
+            summary = self.sticker_cache.summary()
+            yield event.plain_result(
+                "📦 贴纸缓存统计\n"
+                f"内存：{summary['memory_entries']} 条 / {summary['memory_bytes'] / 1024 / 1024:.2f} MB\n"
+                f"磁盘：{summary['disk_entries']} 条 / {summary['disk_bytes'] / 1024 / 1024:.2f} MB\n"
+                f"命中：内存 {summary['memory_hits']} 次，磁盘 {summary['disk_hits']} 次\n"
+                f"未命中：{summary['misses']} 次\n"
+                f"淘汰：内存 {summary['memory_evictions']} 次，磁盘 {summary['disk_evictions']} 次，"
+                f"过期 {summary['disk_expired']} 次\n"
+                f"合并并发请求：{self.render_flight.stats['coalesced']} 次"
+            )
+            return
+
+        # 处理 /draw api 命令（仅管理员）
+        if len(args) > 0 and args[0].lower() == "api":
+            if not event.is_admin():
+                yield event.plain_result("❌ 该命令仅限管理员使用")
+                return
+            summary = self._get_render_client().summary()
+            state_text = {
+                CircuitBreaker.CLOSED: "正常",
+                CircuitBreaker.OPEN: "熔断中",
+                CircuitBreaker.HALF_OPEN: "半开（探测中）",
+            }[summary["breaker_state"]]
+            yield event.plain_result(
+                "🛰 渲染 API 状态\n"
+                f"熔断器：{state_text}（累计熔断 {summary['breaker_opened']} 次，拒绝 {summary['breaker_rejected']} 次）\n"
+                f"并发：进行中 {summary['active']} / {summary['max_concurrency']}，"
+                f"排队 {summary['waiting']}（来自 {summary['queued_keys']} 个群/私聊）\n"
+                f"请求：{summary['requests']} 次，重试 {summary['retries']} 次，"
+                f"失败 {summary['failures']} 次（超时 {summary['timeouts']} 次），"
+                f"排队超时 {summary['queue_timeouts']} 次"
+            )
+            return
+
+        # 处理 /draw stats 命令（仅管理员）
+        if len(args) > 0 and args[0].lower() == "stats":
+            if not event.is_admin():
+                yield event.plain_result("❌ 该命令仅限管理员使用")
+                return
+            yield event.plain_result(self._format_stats())
+            return
+
+        # 处理 /draw profile 命令（仅管理员）
+        if len(args) > 0 and args[0].lower() == "profile":
+            if not event.is_admin():
+                yield event.plain_result("❌ 该命令仅限管理员使用")
+                return
+            if not self.profiler_enabled:
+                yield event.plain_result("采样分析器未启用，请在配置 metrics.profiler_enabled 中开启")
+                return
+            action = args[1].lower() if len(args) > 1 else ""
+            if action == "start":
+                if self.profiler.running:
+                    yield event.plain_result("采样分析器已在运行中")
+                    return
+                self.profiler.start(threading.get_ident())
+                yield event.plain_result(
+                    f"🔬 采样分析器已启动（间隔 {self.profiler.interval * 1000:g} ms），使用 /draw profile stop 查看结果"
+                )
+            elif action == "stop":
+                report = self.profiler.stop()
+                yield event.plain_result(report if report is not None else "采样分析器未在运行")
+            else:
+                yield event.plain_result("用法：/draw profile start|stop")
+            return
+
+        # 处理 /draw reload 命令（仅管理员）
+        if len(args) > 0 and args[0].lower() == "reload":
+            if not event.is_admin():
+                yield event.plain_result("❌ 该命令仅限管理员使用")
+                return
+            try:
+                catalog = await self._reload_catalog()
+            except Exception as e:
+                logger.error(f"重新加载贴纸目录失败: {e}")
+                yield event.plain_result(f"❌ 重新加载失败，继续使用当前目录: {e}")
+                return
+            yield event.plain_result(
+                f"🔄 贴纸目录已重新加载：{len(catalog.pack_index)} 个贴纸包，{catalog.style_count} 个样式"
+            )
+            return
+
         # 处理 /draw <pack> <样式id> <文字> 直接生成模式
         if len(args) >= 3:
             pack_name = args[0].lower()
-            all_packs = self._get_all_packs()
 
             # 检查pack是否存在
-            pack_found = None
-            for pack in all_packs:
-                if pack.lower() == pack_name:
-                    pack_found = pack
-                    break
+            pack_found = self._match_pack(pack_name)
 
             if pack_found:
+                text = " ".join(args[2:])
+                # 文字中的 | 用于分隔批量生成的多段文字
+                texts = [part.strip() for part in text.split("|") if part.strip()] if "|" in text else [text]
                 try:
-                    text = " ".join(args[2:])
+                    target_ids = self._parse_id_spec(args[1], self.batch_max_items)
+                except ValueError:
+                    yield event.plain_result(f"❌ 参数错误，请检查序号是否为数字")
+                    return
+                if not texts:
+                    yield event.plain_result("❌ 请输入要显示的文字")
+                    return
+                if target_ids is None or len(target_ids) * len(texts) > self.batch_max_items:
+                    yield event.plain_result(f"❌ 批量生成一次最多 {self.batch_max_items} 张")
+                    return
 
+                targets = [(target_id, self._resolve_quick_target(pack_found, target_id)) for target_id in target_ids]
+                batch = len(target_ids) * len(texts) > 1
+                if not batch and targets[0][1] is None:
                     if pack_found == "arcaea":
-                        # arcaea 直接生成：/draw arcaea <角色序号> <文字>
-                        characters = self._get_characters_in_pack("arcaea")
-                        char_index = str(int(args[1]))  # 规范化索引
-                        if char_index not in characters:
-                            yield event.plain_result(f"❌ 角色序号 {args[1]} 不存在")
-                            return
-                        character_data = characters[char_index]
-                        character_name = character_data["name"]
-                        styles = character_data.get("styles", [])
-                        style = styles[0] if styles else None
-                        url = self._build_sticker_url(pack_found, character_name, style, text)
+                        yield event.plain_result(f"❌ 角色序号 {args[1]} 不存在")
                     else:
-                        # pjsk 直接生成：/draw pjsk <样式id> <文字>
-                        style_id = int(args[1])
-                        character_info = self._find_character_by_style_id(pack_found, style_id)
-                        if not character_info:
-                            yield event.plain_result(f"❌ 样式ID {style_id} 不存在，请输入 0 到 358 之间的数字")
-                            return
-                        character_name, style = character_info
-                        url = self._build_sticker_url(pack_found, character_name, style, text)
-
-                    try:
-                        async with httpx.AsyncClient() as client:
-                            response = await client.get(url, timeout=30.0)
-                            if response.status_code == 200:
-                                image_bytes = response.content
-                                image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-
-                                yield event.chain_result([
-                                    Comp.Image(file=f"base64://{image_base64}"),
-                                    Comp.Plain(text=f"✨ 贴纸生成完成！\n角色：{character_name}\n文字：{text}")
-                                ])
-                            else:
-                                yield event.plain_result(f"❌ 图片生成失败，状态码: {response.status_code}")
-                    except Exception as e:
-                        logger.error(f"下载图片时出错: {e}")
-                        yield event.plain_result(f"❌ 图片下载失败: {str(e)}")
-                except ValueError:
-                    yield event.plain_result(f"❌ 参数错误，请检查序号是否为数字")
+                        yield event.plain_result(f"❌ 样式ID {target_ids[0]} 不存在，请输入 0 到 358 之间的数字")
+                    return
+
+                # 按需要真正渲染的张数扣除令牌，不存在的序号与命中缓存的贴纸不计入
+                valid_targets = [target for _, target in targets if target is not None]
+                wait = self._check_rate_limit(
+                    event, cost=self._count_renders(pack_found, [(*target, t) for target in valid_targets for t in texts])
+                )
+                if wait > 0:
+                    yield event.plain_result(f"⏳ 请求过于频繁，请 {math.ceil(wait)} 秒后再试")
+                    return
+
+                queue_key = self._get_queue_key(event)
+                if batch:
+                    if valid_targets:
+                        position = self._get_queue_position(queue_key, pack_found, *valid_targets[0], texts[0])
+                        if position:
+                            yield event.plain_result(f"⏳ 渲染排队中，当前第 {position} 位，请稍候")
+                    yield await self._generate_batch(event, pack_found, targets, texts)
+                    return
+
+                character_name, style = targets[0][1]
+                # 只有一段文字时也使用 | 分隔后的结果，去掉首尾多余的 |
+                text = texts[0]
+                position = self._get_queue_position(queue_key, pack_found, character_name, style, text)
+                if position:
+                    yield event.plain_result(f"⏳ 渲染排队中，当前第 {position} 位，请稍候")
+
+                try:
+                    status_code, image_bytes = await self._fetch_sticker(
+                        pack_found, character_name, style, text, queue_key
+                    )
+                    if status_code == 200:
+                        yield event.chain_result([
+                            self._build_sticker_image(event, image_bytes, pack_found, character_name, style, text),
+                            Comp.Plain(text=f"✨ 贴纸生成完成！\n角色：{character_name}\n文字：{text}")
+                        ])
+                    else:
+                        yield event.plain_result(f"❌ 图片生成失败，状态码: {status_code}")
+                except Exception as e:
+                    logger.error(f"下载图片时出错: {e}")
+                    yield event.plain_result(f"❌ 图片下载失败: {str(e)}")
             else:
                 yield event.plain_result(f"❌ 贴纸包 '{pack_name}' 不存在")
             return
@@ -233,6 +2272,7 @@ class StickerPlugin(Star):
             "style_id": None,
             "text": None
         }
+        self._schedule_prefetch(session_key, self.sessions[session_key])
 
         # 获取所有可用的pack列表
         all_packs = self._get_all_packs()
@@ -240,9 +2280,55 @@ class StickerPlugin(Star):
 
         yield event.plain_result(f"欢迎使用贴纸生成器！\n{pack_list_msg}\n\n💡 提示：任何时刻输入 quit 可直接退出")
     
+    def _schedule_prefetch(self, session_key, session):
+        """为会话的当前步骤启动后台预取，并取消该会话上一步尚未完成的预取"""
+        if not self.prefetch_enabled:
+            return
+        self._cancel_prefetch(session_key)
+        task = asyncio.create_task(self._prefetch(session))
+        self._prefetch_tasks[session_key] = task
+        task.add_done_callback(lambda done: self._finish_prefetch(session_key, done))
+
+    def _finish_prefetch(self, session_key, task):
+        if self._prefetch_tasks.get(session_key) is task:
+            del self._prefetch_tasks[session_key]
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug(f"贴纸预取失败: {task.exception()}")
+
+    def _cancel_prefetch(self, session_key):
+        """会话结束、退出或被清理时取消其预取任务"""
+        task = self._prefetch_tasks.pop(session_key, None)
+        if task is not None:
+            task.cancel()
+
+    async def _prefetch(self, session):
+        """预热渲染 API 连接；选包前预热角色列表图；本地渲染模式下预先解码所选角色的底图"""
+        jobs = []
+        if self.render_client is not None and self.render_client.breaker.state != CircuitBreaker.OPEN:
+            jobs.append(self._get_http_client().warm(self.api_url))
+        if session["step"] == "select_pack":
+            jobs.append(self._warm_list_images(HOT_LIST_IMAGES))
+        if self.local_renderer is not None and session.get("character"):
+            if session["step"] == "select_style":
+                style_ids = session.get("id_to_style", {}).values()
+            else:
+                style_ids = [session.get("style_id")]
+            jobs.append(self.local_renderer.warm(
+                self._get_base_image_path(session["pack"], session["character"], style_id)
+                for style_id in style_ids
+            ))
+        await asyncio.gather(*jobs)
+
     @filter.regex(r'.*', flags=re.IGNORECASE)
     async def handle_session_message(self, event: AstrMessageEvent):
         """统一处理会话中的消息"""
+        # 快速路径：该处理器会收到所有消息，没有任何会话或发送者没有会话时直接返回，
+        # 不再解析平台信息
+        self._messages_seen += 1
+        if not self.sessions or not self.sessions.has_sender(event.get_sender_id()):
+            self._messages_skipped += 1
+            return
+
         session_key = self._get_session_key(event)
         
         # 如果没有活跃会话，不处理
@@ -283,21 +2369,33 @@ class StickerPlugin(Star):
         
         if handler is None:
             return
+
+        if step == "input_text":
+            wait = self._check_rate_limit(
+                event, cost=self._count_renders(session["pack"], [(session["character"], session["style_id"], message)])
+            )
+            if wait > 0:
+                # 保留会话，等待后可直接重新输入文字
+                yield event.plain_result(f"⏳ 请求过于频繁，请 {math.ceil(wait)} 秒后重新输入文字")
+                return
+            position = self._get_queue_position(
+                self._get_queue_key(event), session["pack"], session["character"], session["style_id"], message
+            )
+            if position:
+                yield event.plain_result(f"⏳ 渲染排队中，当前第 {position} 位，请稍候")
         
-        result = await handler(event, session, message)
+        with self.metrics.timer("pjsk_sticker_session_step_seconds", step=step):
+            result = await handler(event, session, message)
+        # 进入新步骤后，利用用户思考的时间在后台预取下一步需要的资源
+        if session["step"] != step and session_key in self.sessions:
+            self._schedule_prefetch(session_key, session)
         if result is not None:
             yield result
     
     async def _handle_pack_selection(self, event: AstrMessageEvent, session: dict, message: str):
         """处理pack选择"""
-        all_packs = self._get_all_packs()
-        
         # 尝试匹配pack名（不分大小写）
-        matched_pack = None
-        for pack in all_packs:
-            if message.lower() == pack.lower():
-                matched_pack = pack
-                break
+        matched_pack = self._match_pack(message)
         
         if matched_pack is None:
             return event.plain_result("贴纸包不存在，请重新输入:")
@@ -310,19 +2408,19 @@ class StickerPlugin(Star):
 
         if matched_pack == "arcaea":
             # arcaea 使用专用角色列表图
-            arcaea_image = self._load_image_as_base64("arcaea_list.jpg")
+            arcaea_image = await self._get_list_image(event, "arcaea_list.jpg")
             if arcaea_image:
                 return event.chain_result([
                     Comp.Plain(text=response_text),
-                    Comp.Image(file=f"base64://{arcaea_image}")
+                    arcaea_image
                 ])
         else:
             # pjsk 使用通用角色列表图
-            character_list_image = self._load_image_as_base64("characterListWithIndex.jpeg")
+            character_list_image = await self._get_list_image(event, "characterListWithIndex.jpeg")
             if character_list_image:
                 return event.chain_result([
                     Comp.Plain(text=response_text),
-                    Comp.Image(file=f"base64://{character_list_image}")
+                    character_list_image
                 ])
 
         return event.plain_result(response_text)
@@ -336,45 +2434,51 @@ class StickerPlugin(Star):
         if message not in characters:
             return event.plain_result("角色不存在，请重新输入角色数字:")
 
-        character_data = characters[message]
-        character_name = character_data["name"]
+        record = characters[message]
+        character_name = record.name
         session["character"] = character_name
         session["character_id"] = message
 
         if pack == "arcaea":
             # arcaea: 跳过 style 选择，直接用第一个 style（如有）
-            styles = character_data.get("styles", [])
-            session["style_id"] = styles[0] if styles else None
+            session["style_id"] = record.styles[0] if record.styles else None
             session["step"] = "input_text"
             return event.plain_result(f"已选择角色: {character_name}\n请输入要显示的文字:")
         else:
             # pjsk: 进入 style 选择
             session["step"] = "select_style"
 
-            # 获取该角色的动作列表
-            styles = character_data["styles"]
-            id_list = character_data["id"]
-
-            # 创建id到style的映射
-            id_to_style = {id_val: style for id_val, style in zip(id_list, styles)}
-
-            # 保存映射到会话中
-            session["id_to_style"] = id_to_style
+            # 保存该角色的 id 到 style 映射（引用共享索引，不复制）
+            session["id_to_style"] = record.style_table
+            session["style_page"] = 0
+            session["style_pages"] = await self._count_list_image_pages(f"{character_name}.jpeg")
 
             style_list_msg = "请选择动作(输入数字):"
             response_text = f"已选择角色: {character_name}\n{style_list_msg}"
+            if session["style_pages"] > 1:
+                response_text += f"\n（第 1/{session['style_pages']} 页，输入 n 下一页 / p 上一页）"
 
-            character_image = self._load_image_as_base64(f"{character_name}.jpeg")
+            character_image = await self._get_list_image(event, f"{character_name}.jpeg", page=0)
             if character_image:
                 return event.chain_result([
                     Comp.Plain(text=response_text),
-                    Comp.Image(file=f"base64://{character_image}")
+                    character_image
                 ])
 
             return event.plain_result(response_text)
     
     async def _handle_style_selection(self, event: AstrMessageEvent, session: dict, message: str):
         """处理动作/样式选择"""
+        pages = session.get("style_pages", 0)
+        if pages > 1 and message.lower() in ("n", "p"):
+            page = (session.get("style_page", 0) + (1 if message.lower() == "n" else -1)) % pages
+            session["style_page"] = page
+            response_text = f"第 {page + 1}/{pages} 页（输入 n 下一页 / p 上一页），请选择动作(输入数字):"
+            style_image = await self._get_list_image(event, f"{session['character']}.jpeg", page=page)
+            if style_image:
+                return event.chain_result([Comp.Plain(text=response_text), style_image])
+            return event.plain_result(response_text)
+
         try:
             selected_id = int(message)
             id_to_style = session.get("id_to_style", {})
@@ -398,36 +2502,38 @@ class StickerPlugin(Star):
         try:
             session["text"] = message
             
-            # 构建URL
-            url = self._build_sticker_url(
-                session["pack"],
-                session["character"], 
-                session["style_id"],
-                session["text"]
-            )
-            
-            # 下载图片并转换为base64
+            # 生成图片并转换为base64
             try:
-                async with httpx.AsyncClient() as client:
-                    response = await client.get(url, timeout=30.0)
-                    if response.status_code == 200:
-                        image_bytes = response.content
-                        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-                        
-                        # 结束会话
-                        if session_key in self.sessions:
-                            del self.sessions[session_key]
-                        
-                        # 使用 base64:// URI 格式发送图片
-                        return event.chain_result([
-                            Comp.Image(file=f"base64://{image_base64}"),
-                            Comp.Plain(text="贴纸生成完成！如需再次生成，请输入 /draw")
-                        ])
-                    else:
-                        logger.error(f"下载图片失败，状态码: {response.status_code}")
-                        if session_key in self.sessions:
-                            del self.sessions[session_key]
-                        return event.plain_result(f"图片生成失败，请重试。如需再次生成，请输入 /draw")
+                status_code, image_bytes = await self._fetch_sticker(
+                    session["pack"],
+                    session["character"],
+                    session["style_id"],
+                    session["text"],
+                    self._get_queue_key(event)
+                )
+                if status_code == 200:
+                    sticker_image = self._build_sticker_image(
+                        event,
+                        image_bytes,
+                        session["pack"],
+                        session["character"],
+                        session["style_id"],
+                        session["text"]
+                    )
+                    
+                    # 结束会话
+                    if session_key in self.sessions:
+                        del self.sessions[session_key]
+                    
+                    return event.chain_result([
+                        sticker_image,
+                        Comp.Plain(text="贴纸生成完成！如需再次生成，请输入 /draw")
+                    ])
+                else:
+                    logger.error(f"下载图片失败，状态码: {status_code}")
+                    if session_key in self.sessions:
+                        del self.sessions[session_key]
+                    return event.plain_result(f"图片生成失败，请重试。如需再次生成，请输入 /draw")
             except Exception as e:
                 logger.error(f"下载图片时出错: {e}")
                 if session_key in self.sessions:
@@ -440,20 +2546,22 @@ class StickerPlugin(Star):
                 del self.sessions[session_key]
             return event.plain_result("处理过程中出现错误，请重新开始")
     
+    def _get_base_image_path(self, pack, character, style_id):
+        """获取底图在素材仓库中的相对路径，远程 API 与本地渲染共用"""
+        if pack == "arcaea":
+            # arcaea: style 有值则追加后缀（如 hikari1.png, tairitsu2.png）
+            char_lower = character.lower()
+            filename = f"{char_lower}{style_id}.png" if style_id else f"{char_lower}.png"
+            return f"arcaea/{character}/{filename}"
+        # pjsk: 保留 style_id
+        return f"pjsk/{character}/{character}_{style_id}.png"
+
     def _build_sticker_url(self, pack, character, style_id, text):
         """构建贴纸URL"""
         if not self.api_url:
             raise ValueError("API URL 未配置")
         base_url = self.api_url
-
-        if pack == "arcaea":
-            # arcaea: style 有值则追加后缀（如 hikari1.png, tairitsu2.png）
-            char_lower = character.lower()
-            filename = f"{char_lower}{style_id}.png" if style_id else f"{char_lower}.png"
-            image_path = f"https://raw.githubusercontent.com/kamicry/arcpjsk-hub/main/arcaea/{character}/{filename}"
-        else:
-            # pjsk: 保留 style_id
-            image_path = f"https://raw.githubusercontent.com/kamicry/arcpjsk-hub/main/pjsk/{character}/{character}_{style_id}.png"
+        image_path = f"{BASE_IMAGE_HUB_URL}/{self._get_base_image_path(pack, character, style_id)}"
 
         encoded_text = urllib.parse.quote(text)
 
@@ -461,5 +2569,48 @@ class StickerPlugin(Star):
     
     async def terminate(self):
         """插件销毁时清理资源"""
+        if self._list_image_prewarm_task is not None:
+            self._list_image_prewarm_task.cancel()
+            self._list_image_prewarm_task = None
+        if self._session_sweeper is not None:
+            self._session_sweeper.cancel()
+            self._session_sweeper = None
+        if self._metrics_dumper is not None:
+            self._metrics_dumper.cancel()
+            self._metrics_dumper = None
+        if self._catalog_watcher is not None:
+            self._catalog_watcher.cancel()
+            self._catalog_watcher = None
+        if self.profiler.running:
+            self.profiler.stop()
+        logger.info(
+            f"贴纸会话统计: 活跃 {len(self.sessions)} 个，容量淘汰 {self.sessions.stats['evicted']} 个，"
+            f"超时清理 {self.sessions.stats['expired']} 个"
+        )
         self.sessions.clear()
+        if self.local_renderer is not None:
+            self.local_renderer.shutdown()
+            self.local_renderer = None
+        if self.http_client is not None:
+            stats = self.http_client.stats
+            logger.info(
+                f"贴纸渲染连接池统计: 请求 {stats['requests']} 次，"
+                f"新建连接 {stats['connections_opened']} 次，复用连接 {stats['connections_reused']} 次"
+            )
+            logger.info(f"贴纸渲染请求合并统计: 共节省上游请求 {self.render_flight.stats['coalesced']} 次")
+            await self.http_client.aclose()
+            self.http_client = None
+            self.render_client = None
+        if self.thumbnails is not None and self.thumbnails.stats["built"]:
+            stats = self.thumbnails.stats
+            logger.info(
+                f"贴纸缩略图统计: 生成 {stats['built']} 组，复用磁盘缓存 {stats['reused']} 组，"
+                f"源图 {stats['source_bytes'] / 1024:.0f} KB → 缩略图 {stats['sheet_bytes'] / 1024:.0f} KB"
+            )
+        for label, entry in self.io_runner.stats.items():
+            logger.info(
+                f"贴纸 IO 统计 [{label}]: {entry['calls']} 次，避免事件循环阻塞共 {entry['total_ms']:.2f} ms，"
+                f"单次最长 {entry['max_ms']:.2f} ms"
+            )
+        self.io_runner.shutdown()
         logger.info("贴纸插件已清理")